@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#
+# Compares the old if/elif command dispatch in example.py with the command
+#   registry.
+#
+
+import os, random, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import example
+
+# A fake IRC object that only counts messages
+class FakeIRC:
+    nick = 'miniirc-test'
+    isupport = {}
+
+    def msg(self, target, *msg):
+        self.sent += 1
+
+    def __init__(self):
+        self.sent = 0
+
+# The old dispatcher (copied from example.py before the command registry).
+def old_handle_privmsg(irc, hostmask, args, prefix=example.prefix):
+    channel = args[0]
+    text = args[-1].split(' ')
+    cmd = text[0].lower()
+    if cmd.startswith('meep'):
+        irc.msg(channel, '\u200bMeep!')
+    elif cmd.startswith(prefix):
+        cmd = cmd[len(prefix):]
+        if cmd == 'yay':
+            irc.msg(channel, '\u200bYay!')
+        elif cmd == 'rev':
+            if len(text) > 1:
+                irc.msg(channel, "{}: {}".format(hostmask[0],
+                    ' '.join(text[1:])[::-1]))
+            else:
+                irc.msg(channel, 'Invalid syntax! Syntax: ' + prefix +
+                    'rev <string>')
+        elif cmd == 'about':
+            irc.msg(channel,
+                'I am {}, an example miniirc bot.'.format(irc.nick))
+
+# Generate a stream of mostly normal chatter with some commands mixed in.
+def generate(count, command_ratio, seed=0):
+    rng = random.Random(seed)
+    words = ('the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog',
+        'irc', 'bot', 'hello', 'world', 'python', 'minetest', 'relay')
+    cmds = ('meep', 'Meeeep!', example.prefix + 'yay', example.prefix +
+        'rev some text', example.prefix + 'about', example.prefix + 'rev',
+        example.prefix + 'unknown command')
+    hostmask = ('nick', 'ident', 'host')
+    res = []
+    for i in range(count):
+        if rng.random() < command_ratio:
+            text = rng.choice(cmds)
+        else:
+            text = ' '.join(rng.choice(words)
+                for i in range(rng.randint(3, 20)))
+        res.append((hostmask, ['#lurk', text]))
+    return res
+
+def bench(func, events, repeat):
+    best = None
+    for i in range(repeat):
+        irc = FakeIRC()
+        start = time.perf_counter()
+        for hostmask, args in events:
+            func(irc, hostmask, args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, irc.sent
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=200000,
+        help='The amount of messages to generate.')
+    parser.add_argument('-c', '--command-ratio', type=float, default=0.05,
+        help='The fraction of messages that are commands.')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+        help='How many times to run each benchmark (the best time is used).')
+    args = parser.parse_args()
+
+    # Only dispatch is being compared, so don't rate limit anything.
+    example.user_limiter = example.RateLimiter(float('inf'), 1)
+    example.channel_limiter = example.RateLimiter(float('inf'), 1)
+
+    events = generate(args.count, args.command_ratio)
+    results = {}
+    for name, func in (('if/elif', old_handle_privmsg),
+            ('registry', example.handle_privmsg)):
+        elapsed, sent = bench(func, events, args.repeat)
+        results[name] = elapsed
+        print('{:>10}: {:8.1f} ns/message ({} replies)'.format(name,
+            elapsed / len(events) * 1e9, sent))
+    print('Speedup: {:.2f}x'.format(results['if/elif'] /
+        results['registry']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+#
+# A tiny in-process IRC server for benchmarks. It only understands enough of
+#   the protocol for the bots in this repository (registration, JOIN, PART,
+#   PRIVMSG, NOTICE, NAMES, PING and QUIT).
+#
+
+import asyncio, threading
+
+class _Client:
+    __slots__ = ('writer', 'nick', 'ident', 'host', 'registered', 'channels')
+
+    @property
+    def hostmask(self):
+        return '{}!{}@{}'.format(self.nick, self.ident, self.host)
+
+    def send(self, line):
+        if not self.writer.is_closing():
+            self.writer.write(line.encode('utf-8') + b'\r\n')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.nick = self.ident = None
+        self.host = '127.0.0.1'
+        self.registered = False
+        self.channels = set()
+
+class FakeIRCd:
+    def _numeric(self, client, numeric, *args):
+        client.send(':{} {} {} {}'.format(self.name, numeric,
+            client.nick or '*', ' '.join(args)))
+
+    # Send a line to every member of a channel (except `exclude`).
+    def _broadcast(self, channel, line, exclude=None):
+        for client in self.channels.get(channel.lower(), ()):
+            if client is not exclude:
+                client.send(line)
+
+    def _names(self, client, channel):
+        members = self.channels.get(channel.lower(), ())
+        self._numeric(client, '353', '=', channel,
+            ':' + ' '.join(c.nick for c in members))
+        self._numeric(client, '366', channel, ':End of /NAMES list.')
+
+    def _join(self, client, channel):
+        members = self.channels.setdefault(channel.lower(), set())
+        if client in members:
+            return
+        members.add(client)
+        client.channels.add(channel.lower())
+        self._broadcast(channel, ':{} JOIN {}'.format(client.hostmask,
+            channel))
+        self._names(client, channel)
+
+    def _part(self, client, channel, reason=''):
+        members = self.channels.get(channel.lower())
+        if not members or client not in members:
+            return
+        self._broadcast(channel, ':{} PART {} :{}'.format(client.hostmask,
+            channel, reason))
+        members.discard(client)
+        client.channels.discard(channel.lower())
+
+    def _quit(self, client, reason):
+        line = ':{} QUIT :{}'.format(client.hostmask, reason)
+        seen = {client}
+        for channel in client.channels:
+            for member in self.channels.get(channel, ()):
+                if member not in seen:
+                    seen.add(member)
+                    member.send(line)
+            self.channels[channel].discard(client)
+        client.channels.clear()
+        if self.nicks.get((client.nick or '').lower()) is client:
+            del self.nicks[client.nick.lower()]
+
+    def _register(self, client):
+        client.registered = True
+        self.registered += 1
+        self._numeric(client, '001', ':Welcome to {}'.format(self.name))
+        self._numeric(client, '005', 'CASEMAPPING=rfc1459',
+            'CHANTYPES=#', 'PREFIX=(ov)@+', ':are supported by this server')
+        self._numeric(client, '376', ':End of /MOTD command.')
+
+    def _handle(self, client, line):
+        args = line.split(' ')
+        if ' :' in line:
+            args = line[:line.index(' :')].split(' ')
+            args.append(line[line.index(' :') + 2:])
+        cmd = args.pop(0).upper()
+        self.received += 1
+
+        if cmd == 'PING':
+            client.send(':{} PONG {} :{}'.format(self.name, self.name,
+                args[-1] if args else ''))
+        elif cmd == 'NICK' and args:
+            if args[0].lower() in self.nicks:
+                self._numeric(client, '433', args[0],
+                    ':Nickname is already in use')
+                return
+            self.nicks.pop((client.nick or '').lower(), None)
+            self.nicks[args[0].lower()] = client
+            client.nick = args[0]
+            if not client.registered and client.ident:
+                self._register(client)
+        elif cmd == 'USER' and args:
+            client.ident = args[0]
+            if not client.registered and client.nick:
+                self._register(client)
+        elif cmd == 'CAP' and args and args[0].upper() == 'LS':
+            client.send(':{} CAP * LS :'.format(self.name))
+        elif not client.registered:
+            return
+        elif cmd == 'JOIN' and args:
+            for channel in args[0].split(','):
+                self._join(client, channel)
+        elif cmd == 'PART' and args:
+            for channel in args[0].split(','):
+                self._part(client, channel, args[1] if len(args) > 1 else '')
+        elif cmd == 'NAMES' and args:
+            self._names(client, args[0])
+        elif cmd in ('PRIVMSG', 'NOTICE') and len(args) > 1:
+            self.messages += 1
+            line = ':{} {} {} :{}'.format(client.hostmask, cmd, args[0],
+                args[1])
+            if args[0].lower() in self.channels:
+                self._broadcast(args[0], line, exclude=client)
+            elif args[0].lower() in self.nicks:
+                self.nicks[args[0].lower()].send(line)
+            if self.on_message:
+                self.on_message(self, client, args[0], args[1])
+        elif cmd == 'QUIT':
+            self._quit(client, args[0] if args else '')
+            client.writer.close()
+
+    async def _serve(self, reader, writer):
+        client = _Client(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').rstrip('\r\n')
+                if line:
+                    self._handle(client, line)
+        except OSError:
+            pass
+        finally:
+            self._quit(client, 'Connection closed')
+            writer.close()
+
+    # Add a fake user (without a connection) to a channel and make it send
+    #   a message there. This must be called from the event loop.
+    def inject(self, nick, channel, text, cmd='PRIVMSG'):
+        line = ':{}!user@fake.user {} {} :{}'.format(nick, cmd, channel, text)
+        self._broadcast(channel, line)
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    def __init__(self, name='irc.example', on_message=None):
+        self.name = name
+        self.on_message = on_message
+        self.channels = {}
+        self.nicks = {}
+        self.registered = self.received = self.messages = 0
+        self.server = self.port = None
+
+# Start an event loop in a background thread.
+def start_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+# Start `count` servers on an event loop running in a background thread.
+def start_servers(loop, count, on_message=None):
+    servers = [FakeIRCd('irc{}.example'.format(i), on_message)
+        for i in range(count)]
+    for server in servers:
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    return servers
+
+# Stop servers started with start_servers().
+def stop_servers(loop, servers):
+    for server in servers:
+        loop.call_soon_threadsafe(server.server.close)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=6667)
+    args = parser.parse_args()
+
+    async def main():
+        server = FakeIRCd()
+        await server.start(port=args.port)
+        print('Listening on port {}.'.format(server.port))
+        await server.server.serve_forever()
+    asyncio.run(main())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+#
+# Replays raw IRC lines (generated, or captured with -i) straight into the
+#   bots' handlers without any sockets and reports the time used and the
+#   memory blocks retained per event. --profile and --tracemalloc show where
+#   the time and memory goes.
+#
+
+import cProfile, gc, importlib.util, itertools, os, pstats, random, sys, time
+import tracemalloc
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _root)
+import miniirc
+
+# A fake IRC object that counts messages
+class FakeIRC:
+    connected = True
+    nick = 'bot'
+
+    def msg(self, target, *msg):
+        self.sent += 1
+
+    def quote(self, *msg, force=None):
+        self.sent += 1
+
+    def debug(self, *args, **kwargs):
+        pass
+
+    def disconnect(self, msg=None):
+        pass
+
+    def __init__(self, *args, **kwargs):
+        self.channels = set(args[3]) if len(args) > 3 else set()
+        self.isupport = {}
+        self.sent = 0
+
+# Generate a mix of the traffic the bots see in a busy channel.
+def generate(count, seed=0):
+    rng = random.Random(seed)
+    words = ('the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog',
+        'irc', 'bot', 'hello', 'world', 'python', 'minetest', 'relay')
+    cmds = ('meep', '`yay', '`rev some text', '`about', '`unknown command')
+    users = ['user{}'.format(i) for i in range(200)]
+    servers = ['mtserver{}'.format(i) for i in range(10)]
+    players = ['player{}'.format(i) for i in range(100)]
+
+    lines = []
+    for i in range(count):
+        r = rng.random()
+        user = rng.choice(users)
+        hostmask = '{0}!~{0}@host{1}.example'.format(user, users.index(user))
+        if r < 0.55:
+            if rng.random() < 0.05:
+                text = rng.choice(cmds)
+            else:
+                text = ' '.join(rng.choice(words)
+                    for i in range(rng.randint(3, 20)))
+            lines.append(':{} PRIVMSG #lurk :{}'.format(hostmask, text))
+        elif r < 0.7:
+            # Messages from Minetest servers
+            server = rng.choice(servers)
+            player = rng.choice(players)
+            text = rng.choice(('*** {} joined the game', '*** {} left the game',
+                '<{}> ' + ' '.join(rng.choice(words) for i in range(5)))
+                ).format(player)
+            lines.append(':{0}!~mt@{0}.example PRIVMSG #lurk :{1}'.format(
+                server, text))
+        elif r < 0.8:
+            lines.append(':{} JOIN #lurk'.format(hostmask))
+        elif r < 0.9:
+            reason = 'irc1.example irc2.example' if rng.random() < 0.3 else \
+                'Quit: bye'
+            lines.append(':{} QUIT :{}'.format(hostmask, reason))
+        else:
+            nick = rng.choice(servers + users)
+            lines.append(':irc.example 352 bot #lurk ~{0} {0}.example '
+                'irc.example {0} {1} :0 {0}'.format(nick,
+                'H+' if nick in servers else 'H'))
+    return lines
+
+# Parse lines into {command: [(hostmask, args), ...]}
+def parse(lines):
+    events = {}
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.startswith('<<< '):
+            line = line[4:]
+        try:
+            cmd, hostmask, tags, args = miniirc.ircv3_message_parser(line)
+        except Exception:
+            continue
+        events.setdefault(cmd.upper(), []).append((hostmask, args))
+    return events
+
+# Handler setup, each function returns [(name, irc, handler, events,
+#   colon), ...].
+def setup_example():
+    import example
+    example.user_limiter = example.RateLimiter(float('inf'), 1)
+    example.channel_limiter = example.RateLimiter(float('inf'), 1)
+    return [('example.py PRIVMSG', FakeIRC(), example.handle_privmsg,
+        'PRIVMSG', False)]
+
+def setup_relay():
+    import relay
+    relay.debug = False
+    relay.IRC = FakeIRC
+    for name in ('A', 'B', 'C'):
+        relay.networks[name] = {'ip': name, 'port': 6667, 'nick': 'relay',
+            '#lurk': 'lurk'}
+    relay.parse_networks()
+
+    # Don't start any sender threads.
+    sent = itertools.count()
+    relay.send = lambda irc, target, msg, priority=0 : next(sent)
+    irc = relay.networks['A'][relay.IRC]
+    return [('relay.py ' + event, irc, func, event, False)
+        for event, func in (('PRIVMSG', relay.handle_privmsg),
+            ('JOIN', relay.handle_join), ('QUIT', relay.handle_quit))]
+
+# ".players" isn't generated because its replies are sent by a separate
+#   sender thread (which isn't started when the module is imported).
+def setup_trackr():
+    spec = importlib.util.spec_from_file_location('trackr',
+        os.path.join(_root, 'minetest-trackr.py'))
+    trackr = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(trackr)
+    irc = FakeIRC()
+    return [('trackr PRIVMSG', irc, trackr._handle_privmsg, 'PRIVMSG', True),
+        ('trackr 352', irc, trackr._handle_who, '352', True)]
+
+_lua_code = '''
+function(irc, hostmask, args)
+    local text = args[#args]
+    if text:sub(1, 1) == '`' then
+        irc.msg(args[1], hostmask[1] .. ': Unknown command!')
+    end
+end
+'''
+
+def setup_lua():
+    try:
+        import lua
+    except ImportError as e:
+        print('Skipping lua.py ({}).'.format(e), file=sys.stderr)
+        return []
+    runtime = lua.RuntimeWrapper()
+    func = runtime.wrap_lua_function(runtime.eval(_lua_code))
+    return [('lua.py PRIVMSG', FakeIRC(), func, 'PRIVMSG', False)]
+
+def run(handler, irc, events):
+    for hostmask, args in events:
+        handler(irc, hostmask, args)
+
+def bench(handler, irc, events, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter_ns()
+        run(handler, irc, events)
+        elapsed = time.perf_counter_ns() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    # Memory blocks that are still allocated after another run (so caches
+    #   and leaks show up). Blocks that are freed again aren't counted.
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    run(handler, irc, events)
+    gc.collect()
+    return best / len(events), (sys.getallocatedblocks() - blocks) / \
+        len(events)
+
+def profile(name, handler, irc, events, args):
+    if args.profile or args.profile_dir:
+        prof = cProfile.Profile()
+        prof.runcall(run, handler, irc, events)
+        if args.profile_dir:
+            prof.dump_stats(os.path.join(args.profile_dir, name.replace(' ',
+                '-').replace('.py', '') + '.prof'))
+        if args.profile:
+            print('\n{} ({} events):'.format(name, len(events)))
+            pstats.Stats(prof).sort_stats('cumulative').print_stats(
+                args.top)
+
+    if args.tracemalloc:
+        tracemalloc.start(10)
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        run(handler, irc, events)
+        peak = tracemalloc.get_traced_memory()[1]
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        print('\n{}: peak {:.1f} KiB, top allocations:'.format(name,
+            peak / 1024))
+        for stat in after.compare_to(before, 'lineno')[:args.top]:
+            print('  ' + str(stat))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', help='A file with raw IRC lines to '
+        'replay instead of generated ones.')
+    parser.add_argument('-n', '--count', type=int, default=100000,
+        help='The amount of lines to generate.')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+        help='How many times to run each benchmark (the best time is used).')
+    parser.add_argument('-b', '--bot', action='append',
+        choices=('example', 'relay', 'trackr', 'lua'),
+        help='The bot(s) to benchmark.')
+    parser.add_argument('--profile', action='store_true',
+        help='Print cProfile statistics for each handler.')
+    parser.add_argument('--profile-dir', help='Save cProfile statistics for '
+        'each handler to this directory.')
+    parser.add_argument('--tracemalloc', action='store_true',
+        help='Print the lines that allocate the most memory.')
+    parser.add_argument('--top', type=int, default=15,
+        help='The amount of lines to print with --profile/--tracemalloc.')
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, 'r', errors='replace') as f:
+            events = parse(f)
+    else:
+        events = parse(generate(args.count))
+
+    setups = {'example': setup_example, 'relay': setup_relay,
+        'trackr': setup_trackr, 'lua': setup_lua}
+    handlers = []
+    for bot in args.bot or setups:
+        handlers.extend(setups[bot]())
+
+    results = []
+    for name, irc, handler, event, colon in handlers:
+        # miniirc removes the leading ":" from the last argument unless
+        #   colon is True.
+        evs = [(hostmask, args_[:-1] + [args_[-1][1:]] if not colon and
+            args_ and args_[-1].startswith(':') else args_)
+            for hostmask, args_ in events.get(event, ())]
+        if not evs:
+            continue
+        ns, retained = bench(handler, irc, evs, args.repeat)
+        results.append((name, len(evs), ns, retained))
+        profile(name, handler, irc, evs, args)
+
+    print('\n{:<20} {:>8} {:>10} {:>21}'.format('handler', 'events',
+        'ns/event', 'retained blocks/event'))
+    for name, count, ns, retained in results:
+        print('{:<20} {:>8} {:>10.0f} {:>21.3f}'.format(name, count, ns,
+            retained))
+
+if __name__ == '__main__':
+    main()
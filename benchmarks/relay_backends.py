@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# Compares the memory usage and thread count of relay.py's threaded and
+#   asyncio backends with N networks (hosted by fakeircd.py).
+#
+
+import os, subprocess, sys, time
+_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, _dir)
+import fakeircd
+
+# This is run in a subprocess so every backend starts with a fresh
+#   interpreter.
+_relay_code = r'''
+import sys
+sys.path.insert(0, {root!r})
+import relay
+relay.debug = False
+relay.backend = {backend!r}
+for i, port in enumerate({ports!r}):
+    relay.networks['net{{}}'.format(i)] = {{'ip': '127.0.0.1', 'port': port,
+        'nick': 'relay', '#relay': 'relay'}}
+relay.main()
+'''
+
+def get_proc_status(pid):
+    res = {}
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'Threads'):
+                res[key] = int(value.split()[0])
+    return res
+
+def wait_for(func, timeout):
+    end = time.monotonic() + timeout
+    while not func():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.1)
+    return True
+
+def bench(loop, backend, count, messages, settle):
+    servers = fakeircd.start_servers(loop, count)
+    proc = subprocess.Popen((sys.executable, '-c', _relay_code.format(
+        root=os.path.dirname(_dir), backend=backend,
+        ports=[server.port for server in servers])),
+        stderr=subprocess.DEVNULL)
+    try:
+        start = time.monotonic()
+        joined = lambda : all(server.channels.get('#relay')
+            for server in servers)
+        if not wait_for(joined, 30 + count):
+            raise TimeoutError('The relay did not join every network.')
+        connect_time = time.monotonic() - start
+
+        # Send some messages so that send queues are created.
+        def inject():
+            for i, server in enumerate(servers):
+                for j in range(messages):
+                    server.inject('user{}'.format(i), '#relay',
+                        'Message {}'.format(j))
+        loop.call_soon_threadsafe(inject)
+        time.sleep(settle)
+        status = get_proc_status(proc.pid)
+        status['connect_time'] = connect_time
+        status['relayed'] = sum(server.messages for server in servers)
+        return status
+    finally:
+        proc.kill()
+        proc.wait()
+        fakeircd.stop_servers(loop, servers)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('networks', type=int, nargs='*', default=[10, 50],
+        help='The amount of networks to test with.')
+    parser.add_argument('-m', '--messages', type=int, default=5,
+        help='Messages to send in each network before measuring.')
+    parser.add_argument('-s', '--settle', type=float, default=3,
+        help='Seconds to wait before measuring.')
+    args = parser.parse_args()
+
+    loop = fakeircd.start_loop()
+    print('{:>8} {:>8} {:>10} {:>8} {:>10} {:>8}'.format('networks',
+        'backend', 'RSS (KiB)', 'threads', 'connect', 'relayed'))
+    for count in args.networks:
+        for backend in ('threads', 'asyncio'):
+            res = bench(loop, backend, count, args.messages, args.settle)
+            print('{:>8} {:>8} {:>10} {:>8} {:>9.2f}s {:>8}'.format(count,
+                backend, res['VmRSS'], res['Threads'], res['connect_time'],
+                res['relayed']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+#
+# End-to-end relay.py benchmark: N fake networks (hosted by fakeircd.py) get
+#   synthetic chat at a fixed rate and every relayed copy is timed. Results
+#   are printed and appended (as one JSON object per line) to an output file
+#   so that they can be compared between commits.
+#
+
+import asyncio, json, os, random, subprocess, sys, time
+_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, _dir)
+import fakeircd
+from relay_backends import wait_for
+
+_relay_code = r'''
+import sys
+sys.path.insert(0, {root!r})
+import relay
+relay.debug = False
+relay.backend = {backend!r}
+relay.workers = {workers!r}
+relay.send_burst = 1000000
+relay.send_interval = 0.000001
+relay.queue_limit = 1000000
+for i, port in enumerate({ports!r}):
+    relay.networks['net{{}}'.format(i)] = {{'ip': '127.0.0.1', 'port': port,
+        'nick': 'relay', '#relay': 'relay'}}
+relay.main()
+'''
+
+# Get the relay's process and all of its children (worker processes).
+def get_pids(pid):
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [pid]
+    for pid in pids:
+        pids.extend(children.get(pid, ()))
+    return pids
+
+# Returns (CPU seconds, RSS in KiB) for a process tree.
+def get_usage(pid):
+    cpu = rss = 0
+    tick = os.sysconf('SC_CLK_TCK')
+    for pid in get_pids(pid):
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                stat = f.read()
+            with open('/proc/{}/status'.format(pid)) as f:
+                status = f.read()
+        except OSError:
+            continue
+        fields = stat[stat.rindex(')') + 2:].split()
+        cpu += (int(fields[11]) + int(fields[12])) / tick
+        for line in status.split('\n'):
+            if line.startswith('VmRSS:'):
+                rss += int(line.split()[1])
+    return cpu, rss
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+class Driver:
+    def on_message(self, server, client, target, text):
+        _, _, msg_id = text.rpartition(' ')
+        sent = self.sent.get(msg_id)
+        if sent is not None:
+            self.latencies.append(time.monotonic() - sent)
+
+    # Inject `rate` messages per second for `duration` seconds, spread over
+    #   every server.
+    async def replay(self, rate, duration):
+        start = time.monotonic()
+        end = start + duration
+        injected = 0
+        while time.monotonic() < end:
+            target = int((time.monotonic() - start) * rate)
+            while injected < target:
+                server = random.choice(self.servers)
+                msg_id = str(injected)
+                self.sent[msg_id] = time.monotonic()
+                server.inject('user{}'.format(random.randrange(100)),
+                    '#relay', 'Synthetic message {}'.format(msg_id))
+                injected += 1
+            await asyncio.sleep(0.005)
+        return injected
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.sent = {}
+        self.latencies = []
+
+def bench(loop, backend, workers, count, rate, duration, settle):
+    servers = fakeircd.start_servers(loop, count)
+    driver = Driver(servers)
+    proc = subprocess.Popen((sys.executable, '-c', _relay_code.format(
+        root=os.path.dirname(_dir), backend=backend, workers=workers,
+        ports=[server.port for server in servers])),
+        stderr=subprocess.DEVNULL)
+    try:
+        joined = lambda : all(server.channels.get('#relay')
+            for server in servers)
+        if not wait_for(joined, 30 + count):
+            raise TimeoutError('The relay did not join every network.')
+        for server in servers:
+            server.on_message = driver.on_message
+
+        cpu_start, _ = get_usage(proc.pid)
+        start = time.monotonic()
+        injected = asyncio.run_coroutine_threadsafe(driver.replay(rate,
+            duration), loop).result()
+        expected = injected * (count - 1)
+        wait_for(lambda : len(driver.latencies) >= expected, settle)
+        elapsed = time.monotonic() - start
+        cpu_end, rss = get_usage(proc.pid)
+    finally:
+        proc.kill()
+        proc.wait()
+        fakeircd.stop_servers(loop, servers)
+
+    latencies = sorted(driver.latencies)
+    return {
+        'backend': backend, 'workers': workers, 'networks': count,
+        'rate': rate, 'duration': duration, 'injected': injected,
+        'expected': expected, 'relayed': len(latencies),
+        'msgs_per_second': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+        'cpu_percent': (cpu_end - cpu_start) / elapsed * 100,
+        'rss_kib': rss,
+    }
+
+def get_commit():
+    try:
+        return subprocess.check_output(('git', 'rev-parse', '--short',
+            'HEAD'), cwd=_dir, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('networks', type=int, nargs='*', default=[5],
+        help='The amount of networks to test with.')
+    parser.add_argument('-r', '--rate', type=float, default=100,
+        help='Messages per second to inject (over every network).')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+        help='Seconds to inject messages for.')
+    parser.add_argument('-s', '--settle', type=float, default=10,
+        help='Maximum seconds to wait for relayed messages afterwards.')
+    parser.add_argument('-b', '--backend', action='append',
+        choices=('threads', 'asyncio'), help='The backend(s) to test.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+        help='The amount of relay worker processes.')
+    parser.add_argument('-o', '--output', default='relay_throughput.jsonl',
+        help='The file to append results to.')
+    args = parser.parse_args()
+
+    loop = fakeircd.start_loop()
+    commit = get_commit()
+    print('{:>8} {:>8} {:>8} {:>10} {:>9} {:>9} {:>6} {:>10}'.format(
+        'networks', 'backend', 'relayed', 'msgs/s', 'p50', 'p99', 'CPU',
+        'RSS (KiB)'))
+    with open(args.output, 'a') as f:
+        for count in args.networks:
+            for backend in args.backend or ('threads', 'asyncio'):
+                res = bench(loop, backend, args.workers, count, args.rate,
+                    args.duration, args.settle)
+                res['commit'] = commit
+                res['time'] = int(time.time())
+                f.write(json.dumps(res, sort_keys=True) + '\n')
+                f.flush()
+                print('{:>8} {:>8} {:>8} {:>10.1f} {:>7.1f}ms {:>7.1f}ms '
+                    '{:>5.0f}% {:>10}'.format(count, backend,
+                    '{}/{}'.format(res['relayed'], res['expected']),
+                    res['msgs_per_second'], res['p50_ms'] or 0,
+                    res['p99_ms'] or 0, res['cpu_percent'], res['rss_kib']))
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,8 @@
 # © 2018 by luk3yx
 #
 
-import miniirc, sys
+import miniirc, sys, time
+from collections import OrderedDict
 assert miniirc.ver >= (1,4,0), 'This bot requires miniirc >= v1.4.0.'
 
 # Variables
@@ -22,36 +23,214 @@ prefix   = '`'
 ip = 'xeroxirc.net'
 port = 6697
 
+# Rate limiting: every user (ident@host) can run user_burst commands at once
+#   and then one every user_interval seconds, channels are limited in the
+#   same way. At most max_buckets users/channels are remembered.
+user_burst       = 3
+user_interval    = 5
+channel_burst    = 6
+channel_interval = 2
+max_buckets      = 1024
+
+# The maximum amount of cached command responses.
+max_cached       = 256
+
 # Welcome!
 print('Welcome to {}!'.format(nick), file=sys.stderr)
-irc = IRC(ip, port, nick, channels, ident=ident, realname=realname,
+irc = miniirc.IRC(ip, port, nick, channels, ident=ident, realname=realname,
     ns_identity=identity, debug=debug, auto_connect=False)
 
+# Token buckets, the least recently used buckets are removed when there are
+#   more than `size` of them.
+class RateLimiter:
+    __slots__ = ('burst', 'interval', 'size', 'buckets', 'limited')
+
+    # Returns True if key can run a command right now.
+    def allow(self, key):
+        now = time.monotonic()
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst,
+                bucket[0] + (now - bucket[1]) / self.interval)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            self.limited += 1
+
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.size:
+            self.buckets.popitem(last=False)
+        return allowed
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def __init__(self, burst, interval, size=1024):
+        self.burst = burst
+        self.interval = interval
+        self.size = size
+        self.buckets = OrderedDict()
+        self.limited = 0
+
+# A size-limited cache with expiring entries.
+class TTLCache:
+    __slots__ = ('size', 'entries', 'hits', 'misses')
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl):
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+user_limiter    = RateLimiter(user_burst, user_interval, max_buckets)
+channel_limiter = RateLimiter(channel_burst, channel_interval, max_buckets)
+cache           = TTLCache(max_cached)
+
+# Records messages sent by commands so they can be cached.
+class _Recorder:
+    __slots__ = ('irc', 'sent')
+
+    def msg(self, target, *msg):
+        self.sent.append((target, ' '.join(msg)))
+
+    def __getattr__(self, attr):
+        return getattr(self.irc, attr)
+
+    def __init__(self, irc):
+        self.irc = irc
+        self.sent = []
+
+# Commands
+#   Prefixed commands are stored in a dict, unprefixed triggers are stored in a
+#   trie so that "meeeep" and "meep!" still work.
+commands = {}
+triggers = {}
+
+# Register a prefixed command. The function is called with
+#   (irc, hostmask, channel, args), args being the unsplit text after the
+#   command name. If cache is set, responses are cached for that many
+#   seconds, this should only be used on commands that always send the same
+#   response for the same channel and arguments.
+def command(*names, cache=None):
+    def add_command(func):
+        func.cache_ttl = cache
+        for name in names:
+            commands[name.lower()] = func
+        return func
+    return add_command
+
+# Register an unprefixed trigger, any message starting with one of the
+#   triggers will call the function.
+def trigger(*words):
+    def add_trigger(func):
+        for word in words:
+            node = triggers
+            for char in word.lower():
+                node = node.setdefault(char, {})
+            node[None] = func
+        return func
+    return add_trigger
+
+# Find the shortest trigger text starts with.
+def _find_trigger(text):
+    node = triggers
+    for char in text:
+        node = node.get(char.lower())
+        if node is None:
+            return None
+        elif None in node:
+            return node[None]
+    return None
+
+# Run a command, applying rate limits and the response cache.
+def run_command(func, irc, hostmask, channel, args):
+    if not user_limiter.allow(hostmask[1:]):
+        return
+    if channel[:1] in irc.isupport.get('CHANTYPES', '#&') and \
+            not channel_limiter.allow(channel.lower()):
+        return
+
+    ttl = getattr(func, 'cache_ttl', None)
+    if not ttl:
+        return func(irc, hostmask, channel, args)
+
+    key = (func, irc.nick, channel.lower(), args)
+    sent = cache.get(key)
+    if sent is None:
+        recorder = _Recorder(irc)
+        func(recorder, hostmask, channel, args)
+        sent = tuple(recorder.sent)
+        cache.set(key, sent, ttl)
+    for target, msg in sent:
+        irc.msg(target, msg)
+
 # Handle normal messages
-# This could probably be better than a large if/else statement.
 @irc.Handler('PRIVMSG', colon=False)
 def handle_privmsg(irc, hostmask, args):
-    channel = args[0]
-    text = args[-1].split(' ')
-    cmd = text[0].lower()
-    # Unprefixed commands here
-    if cmd.startswith('meep'):
-        irc.msg(channel, '\u200bMeep!')
-    elif cmd.startswith(prefix):
-        # Prefixed commands
-        cmd = cmd[len(prefix):]
-        if cmd == 'yay':
-            irc.msg(channel, '\u200bYay!')
-        elif cmd == 'rev':
-            if len(text) > 1:
-                irc.msg(channel, "{}: {}".format(hostmask[0],
-                    ' '.join(text[1:])[::-1]))
-            else:
-                irc.msg(channel, 'Invalid syntax! Syntax: ' + prefix +
-                    'rev <string>')
-        elif cmd == 'about':
-            irc.msg(channel,
-                'I am {}, an example miniirc bot.'.format(irc.nick))
+    text = args[-1]
+    if not text:
+        return
+
+    # Unprefixed commands
+    if text[0].lower() in triggers:
+        func = _find_trigger(text)
+        if func:
+            return run_command(func, irc, hostmask, args[0], text)
+
+    # Prefixed commands, text is only split if it starts with the prefix.
+    if text.startswith(prefix):
+        cmd, _, cmd_args = text[len(prefix):].partition(' ')
+        func = commands.get(cmd.lower())
+        if func:
+            run_command(func, irc, hostmask, args[0], cmd_args)
+
+@trigger('meep')
+def meep(irc, hostmask, channel, args):
+    irc.msg(channel, '\u200bMeep!')
+
+@command('yay')
+def yay(irc, hostmask, channel, args):
+    irc.msg(channel, '\u200bYay!')
+
+@command('rev')
+def rev(irc, hostmask, channel, args):
+    if args:
+        irc.msg(channel, "{}: {}".format(hostmask[0], args[::-1]))
+    else:
+        irc.msg(channel, 'Invalid syntax! Syntax: ' + prefix + 'rev <string>')
+
+@command('about', cache=60)
+def about(irc, hostmask, channel, args):
+    irc.msg(channel, 'I am {}, an example miniirc bot.'.format(irc.nick))
+
+@command('stats')
+def stats(irc, hostmask, channel, args):
+    irc.msg(channel, ('Cache: {} hits, {} misses, {} entries. Rate limited: '
+        '{} user, {} channel. Buckets: {} users, {} channels.').format(
+        cache.hits, cache.misses, len(cache), user_limiter.limited,
+        channel_limiter.limited, len(user_limiter), len(channel_limiter)))
 
 # Connect
 if __name__ == '__main__':
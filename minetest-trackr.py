@@ -8,11 +8,14 @@
 # © 2018 by luk3yx
 #
 
-import miniirc, os, time
+import atexit, bisect, miniirc, os, queue, threading, time
+
+# The channels to track servers in
+channels = ['#Edgy1']
 
 # Create the IRC object
 _irc = miniirc.IRC(
-    'xeroxirc.net', 6697, 'trackr', ['#Edgy1'],
+    'xeroxirc.net', 6697, 'trackr', channels,
     realname = 'Minetest player tracker',
     ns_identity = 'username password',
     auto_connect = False
@@ -22,14 +25,402 @@ servers  = {}
 admins   = {'invalid/your-hostmask-here'}
 cooldown = 15
 
+# The delay between lines of .players replies
+send_interval = 0.5
+
+# The maximum amount of players to list in .find replies
+find_limit = 10
+
+# Servers and players are saved to state_file (if set) so that restarts are
+#   fast. Changes are appended to state_file + '.journal' (which is flushed
+#   every flush_interval seconds), and compacted into state_file every
+#   compact_interval seconds and on exit.
+state_file       = None
+flush_interval   = 5
+compact_interval = 300
+
+# WHO requests for a channel are merged until there haven't been any new
+#   ones for who_delay seconds (or who_max_delay seconds after the first
+#   one), and are sent who_interval seconds apart so joining lots of
+#   channels at once doesn't flood the server. WHOX is used if the server
+#   supports it.
+who_delay     = 1
+who_max_delay = 10
+who_interval  = 1
+
 # Odd/even
 plural = lambda n : '' if n == 1 else 's'
 
+# Per-channel state. Player lists are stored once per server (in servers) and
+#   shared between every channel the server is voiced in. Rendered .players
+#   replies are cached per byte limit ({limit: lines}) until a player list
+#   or the channel's server list changes.
+class Channel:
+    __slots__ = ('servers', 'last_list', 'cache', 'unconfirmed')
+
+    def __init__(self):
+        self.servers = set()
+        self.last_list = 0
+        self.cache = {}
+        self.unconfirmed = set()
+
+# servers, _channels and _server_channels ({'server': {'#channel', ...}})
+#   should only be modified while holding _lock.
+_lock = threading.Lock()
+_channels = {}
+_server_channels = {}
+
+def _get_channel(channel):
+    channel = channel.lower()
+    chan = _channels.get(channel)
+    if chan is None:
+        chan = _channels[channel] = Channel()
+    return chan
+
+# Clear the .players cache of every channel a server is in.
+def _changed(server):
+    for channel in _server_channels.get(server, ()):
+        _channels[channel].cache.clear()
+
+# The state journal, entries are tab-separated lines ("S server",
+#   "-S server", "P server player", "-P server player", "C #channel server"
+#   or "-C #channel server").
+_journal_file = None
+def _journal(*entry):
+    if _journal_file is not None:
+        _journal_file.write('\t'.join(entry) + '\n')
+
+# A server's players, kept sorted so that .players never has to sort them.
+class Players:
+    __slots__ = ('names', 'sorted')
+
+    def add(self, player):
+        if player in self.names:
+            return False
+        self.names.add(player)
+        bisect.insort(self.sorted, player)
+        return True
+
+    def remove(self, player):
+        if player not in self.names:
+            return False
+        self.names.remove(player)
+        del self.sorted[bisect.bisect_left(self.sorted, player)]
+        return True
+
+    def __contains__(self, player):
+        return player in self.names
+
+    def __iter__(self):
+        return iter(self.sorted)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __init__(self):
+        self.names = set()
+        self.sorted = []
+
+# The reverse index, {'casefolded player': {'server': 'Player'}}, and a
+#   sorted list of its keys for prefix searches.
+_index = {}
+_index_names = []
+
+def _add_player(server, player):
+    if not servers[server].add(player):
+        return False
+    _journal('P', server, player)
+    key = player.casefold()
+    entry = _index.get(key)
+    if entry is None:
+        entry = _index[key] = {}
+        bisect.insort(_index_names, key)
+    entry[server] = player
+    return True
+
+def _remove_player(server, player):
+    if not servers[server].remove(player):
+        return False
+    _journal('-P', server, player)
+    key = player.casefold()
+    entry = _index[key]
+    del entry[server]
+    if not entry:
+        del _index[key]
+        del _index_names[bisect.bisect_left(_index_names, key)]
+    return True
+
+# Replace a server's player list, returns True if anything changed.
+def _set_players(server, players):
+    if server not in servers:
+        servers[server] = Players()
+        _journal('S', server)
+    old = servers[server]
+    changed = False
+    for player in [player for player in old if player not in players]:
+        changed = _remove_player(server, player) or changed
+    for player in players:
+        changed = _add_player(server, player) or changed
+    return changed
+
+def _remove_server(server):
+    if server not in servers:
+        return False
+    _set_players(server, ())
+    del servers[server]
+    _journal('-S', server)
+    return True
+
+# Add a server to a channel, returns True if it wasn't being tracked in any
+#   channel.
+def _add_to_channel(channel, server):
+    channel = channel.lower()
+    chan = _get_channel(channel)
+    if server in chan.servers:
+        return False
+    chan.servers.add(server)
+    chan.cache.clear()
+    _journal('C', channel, server)
+    chans = _server_channels.setdefault(server, set())
+    chans.add(channel)
+    if server in servers:
+        return False
+    servers[server] = Players()
+    _journal('S', server)
+    return True
+
+# Remove a server from a channel, the server is forgotten when it isn't in
+#   any channels.
+def _remove_from_channel(channel, server):
+    channel = channel.lower()
+    chan = _channels.get(channel)
+    if chan is None or server not in chan.servers:
+        return False
+    chan.servers.remove(server)
+    chan.unconfirmed.discard(server)
+    chan.cache.clear()
+    _journal('-C', channel, server)
+    chans = _server_channels[server]
+    chans.discard(channel)
+    if not chans:
+        del _server_channels[server]
+        _remove_server(server)
+    return True
+
+def _remove_channel(channel):
+    chan = _channels.get(channel.lower())
+    if chan is not None:
+        for server in tuple(chan.servers):
+            _remove_from_channel(channel, server)
+        del _channels[channel.lower()]
+
+# Saved state
+def _apply(entry):
+    op, server = entry[:2]
+    if op in ('C', '-C'):
+        if len(entry) > 2:
+            (_add_to_channel if op == 'C' else _remove_from_channel)(server,
+                entry[2])
+    elif op == 'S' and server not in servers:
+        servers[server] = Players()
+    elif op == '-S':
+        for channel in tuple(_server_channels.get(server, ())):
+            _remove_from_channel(channel, server)
+        _remove_server(server)
+    elif op == 'P' and server in servers and len(entry) > 2:
+        _add_player(server, entry[2])
+    elif op == '-P' and server in servers and len(entry) > 2:
+        _remove_player(server, entry[2])
+
+# Write every server and player to state_file and start a new journal.
+#   This must be called while holding _lock.
+def _compact():
+    global _journal_file
+    with open(state_file + '.tmp', 'w', encoding='utf-8') as f:
+        for server, players in servers.items():
+            f.write('S\t{}\n'.format(server))
+            for player in players:
+                f.write('P\t{}\t{}\n'.format(server, player))
+        for channel, chan in _channels.items():
+            for server in chan.servers:
+                f.write('C\t{}\t{}\n'.format(channel, server))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(state_file + '.tmp', state_file)
+    if _journal_file is not None:
+        _journal_file.close()
+    _journal_file = open(state_file + '.journal', 'w', encoding='utf-8')
+
+def save_state():
+    if state_file:
+        with _lock:
+            _compact()
+
+# Load state_file and its journal. Loaded servers are removed after the next
+#   WHO reply for their channel if they aren't voiced any more.
+def load_state():
+    if not state_file:
+        return
+    with _lock:
+        for fn in (state_file, state_file + '.journal'):
+            try:
+                f = open(fn, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            with f:
+                for line in f:
+                    # Ignore incomplete lines
+                    if not line.endswith('\n'):
+                        break
+                    entry = line[:-1].split('\t')
+                    if len(entry) > 1:
+                        _apply(entry)
+
+        # Older state files don't store channels.
+        for server in tuple(servers):
+            if server not in _server_channels:
+                _add_to_channel(channels[0], server)
+        for chan in _channels.values():
+            chan.unconfirmed.update(chan.servers)
+        _compact()
+
+def _state_writer():
+    last_compact = time.monotonic()
+    while True:
+        time.sleep(flush_interval)
+        with _lock:
+            if time.monotonic() - last_compact >= compact_interval:
+                _compact()
+                last_compact = time.monotonic()
+            else:
+                _journal_file.flush()
+
+# Get the servers in chan that a player is on ({'server': 'Player'}).
+def where(player, chan):
+    return {server: name for server, name in
+        _index.get(player.casefold(), {}).items() if server in chan.servers}
+
+# Returns (matches, total), matches being up to `limit` (player, servers)
+#   tuples.
+def find(prefix, chan, limit=find_limit):
+    prefix = prefix.casefold()
+    start = bisect.bisect_left(_index_names, prefix)
+    end = bisect.bisect_left(_index_names, prefix + '\U0010ffff', start)
+    matches = []
+    total = 0
+    for key in _index_names[start:end]:
+        found = sorted(server for server in _index[key]
+            if server in chan.servers)
+        if found:
+            total += 1
+            if len(matches) < limit:
+                matches.append((_index[key][found[0]], found))
+    return matches, total
+
+# Get the maximum length (in bytes) of a message sent to target.
+def get_byte_limit(irc, target):
+    overhead = len('PRIVMSG {} :\r\n'.format(target).encode('utf-8'))
+    overhead += len(':{}!{}@ '.format(irc.nick, irc.ident).encode('utf-8'))
+    return irc.msglen - overhead - 63
+
+# Split a server's player list into chunks that fit in limit bytes.
+def _split_players(server, players, limit):
+    prefix = '\2{}\2: '.format(server)
+    chunk = prefix
+    for player in players:
+        new = chunk + (player if chunk == prefix else ', ' + player)
+        if len(new.encode('utf-8')) > limit and chunk != prefix:
+            yield chunk
+            new = prefix + player
+        chunk = new
+    yield chunk
+
+# Render the .players reply, packing as many servers as possible into each
+#   line.
+def _render_players(chan, limit, sep=' | '):
+    lines = []
+    total    = 0
+    tplayers = 0
+    for server in sorted(chan.servers):
+        players = servers[server]
+        if not players:
+            continue
+        total    += 1
+        tplayers += len(players)
+        for chunk in _split_players(server, players, limit):
+            if lines and len((lines[-1] + sep + chunk).encode('utf-8')) <= \
+                    limit:
+                lines[-1] += sep + chunk
+            else:
+                lines.append(chunk)
+
+    inactive = len(chan.servers) - total
+    lines.append(('Total: \2{} player{}\2 across \2{} active server{}\2'
+        ' (and {} inactive server{}).').format(tplayers, plural(tplayers),
+        total, plural(total), inactive, plural(inactive)))
+    return lines
+
+def get_players_reply(irc, chan, target):
+    limit = get_byte_limit(irc, target)
+    with _lock:
+        lines = chan.cache.get(limit)
+        if lines is None:
+            lines = chan.cache[limit] = _render_players(chan, limit)
+    return lines
+
+# Send messages in the background, send_interval seconds apart.
+_send_queue = queue.Queue()
+def _sender():
+    while True:
+        irc, target, msg = _send_queue.get()
+        irc.msg(target, msg)
+        time.sleep(send_interval)
+
+# Pending WHO requests ({'#channel': [irc, due, deadline]})
+_who_pending = {}
+_who_cond = threading.Condition()
+
+def request_who(irc, channel):
+    channel = channel.lower()
+    now = time.monotonic()
+    with _who_cond:
+        pending = _who_pending.get(channel)
+        if pending is None:
+            _who_pending[channel] = [irc, now + who_delay,
+                now + who_max_delay]
+        else:
+            pending[0] = irc
+            pending[1] = min(now + who_delay, pending[2])
+        _who_cond.notify()
+
+# Only the channel, nick and flags are requested with WHOX.
+def send_who(irc, channel):
+    if 'WHOX' in irc.isupport:
+        irc.quote('WHO', channel, '%cnf')
+    else:
+        irc.quote('WHO', channel)
+
+def _who_sender():
+    while True:
+        with _who_cond:
+            while True:
+                now = time.monotonic()
+                due = [channel for channel, pending in _who_pending.items()
+                    if pending[1] <= now]
+                if due:
+                    break
+                timeout = min((pending[1] for pending in
+                    _who_pending.values()), default=None)
+                _who_cond.wait(None if timeout is None else timeout - now)
+            batch = [(channel, _who_pending.pop(channel)[0])
+                for channel in due]
+        for channel, irc in batch:
+            send_who(irc, channel)
+            time.sleep(who_interval)
+
 # Handle PRIVMSGs
-last_list = 0
 @miniirc.Handler('PRIVMSG')
 def _handle_privmsg(irc, hostmask, args):
-    global last_list
     nick = hostmask[0]
     msg  = args[-1][1:]
 
@@ -39,15 +430,20 @@ def _handle_privmsg(irc, hostmask, args):
             n = args[-1].split(' ', 3)
             if len(n) <= 2:
                 return
-            if n[2] == 'joined':
-                servers[nick].add(n[1])
-            elif n[2] == 'left' and n[1] in servers[nick]:
-                servers[nick].remove(n[1])
+            with _lock:
+                if nick not in servers:
+                    return
+                if n[2] == 'joined' and _add_player(nick, n[1]):
+                    _changed(nick)
+                elif n[2] == 'left' and _remove_player(nick, n[1]):
+                    _changed(nick)
             return
         elif args[-1].startswith(':Connected players: '):
-            servers[nick] = set(args[-1][20:].replace(' ', '').split(','))
-            if '' in servers[nick]:
-                servers[nick].remove('')
+            players = set(args[-1][20:].replace(' ', '').split(','))
+            players.discard('')
+            with _lock:
+                if nick in servers and _set_players(nick, players):
+                    _changed(nick)
             return
 
     # Check for MT players
@@ -58,80 +454,199 @@ def _handle_privmsg(irc, hostmask, args):
             nick = '{}@{}'.format(n[0][1:-1], nick)
             msg  = n[1].strip()
 
+    # The admin command works anywhere (including private messages).
+    if hostmask[-1] in admins and msg == (irc.nick + ': die'):
+        irc.disconnect(hostmask[0] +
+            ' ordered me to die- wait, why did I listen?')
+        save_state()
+        os._exit(0)
+
+    # Other commands only work in tracked channels.
+    chan = _channels.get(args[0].lower())
+    if chan is None:
+        return
+
     # Check for the players command
     if msg == '.players':
         t = time.time()
-        if t <= last_list + cooldown:
+        if t <= chan.last_list + cooldown:
             irc.msg(args[0], nick + ': You can only run \2.players\2 once',
                 'every \2{} seconds\2.'.format(cooldown))
             return
-        last_list = t
-
-        # Get the player list
-        total    = 0
-        tplayers = 0
-        for server in servers:
-            if len(servers[server]) > 0:
-                total    += 1
-                tplayers += len(servers[server])
-                players   = list(servers[server])
-                players.sort()
-                irc.msg(args[0], 'Players on \2{}\2: {}'.format(server,
-                    ', '.join(players)))
-                last_list += 0.5
-                time.sleep(0.5)
-        inactive = len(servers) - total
-        irc.msg(args[0], ('Total: \2{} player{}\2 across \2{} active server{}\2'
-            ' (and {} inactive server{}).').format(tplayers, plural(tplayers),
-            total, plural(total), inactive, plural(inactive)))
-    elif hostmask[-1] in admins and msg == (irc.nick + ': die'):
-        irc.disconnect(hostmask[0] +
-            ' ordered me to die- wait, why did I listen?')
-        os._exit(0)
 
-# Add a server
-def add_server(irc, server):
+        # The cooldown starts after the reply has been sent.
+        lines = get_players_reply(irc, chan, args[0])
+        chan.last_list = t + send_interval * (len(lines) - 1)
+        for line in lines:
+            _send_queue.put((irc, args[0], line))
+    elif msg.startswith('.where '):
+        player = msg[7:].strip()
+        with _lock:
+            found = sorted(where(player, chan).items())
+        if found:
+            irc.msg(args[0], '{}: \2{}\2 is on {}.'.format(nick, found[0][1],
+                ', '.join('\2{}\2'.format(server) for server, _ in found)))
+        else:
+            irc.msg(args[0], "{}: I can't find \2{}\2 on any server.".format(
+                nick, player))
+    elif msg.startswith('.find '):
+        prefix = msg[6:].strip()
+        if not prefix:
+            return
+        with _lock:
+            matches, total = find(prefix, chan)
+        if not matches:
+            irc.msg(args[0], '{}: No players start with \2{}\2.'.format(nick,
+                prefix))
+            return
+        res = ', '.join('\2{}\2 ({})'.format(player, ', '.join(found))
+            for player, found in matches)
+        if total > len(matches):
+            res += ' and {} more'.format(total - len(matches))
+        irc.msg(args[0], '{}: {}.'.format(nick, res))
+    elif msg == '.count':
+        with _lock:
+            tplayers = sum(len(servers[server]) for server in chan.servers)
+            total = sum(1 for server in chan.servers if servers[server])
+            inactive = len(chan.servers) - total
+        irc.msg(args[0], ('{}: \2{} player{}\2 across \2{} active server{}'
+            '\2 (and {} inactive server{}).').format(nick, tplayers,
+            plural(tplayers), total, plural(total), inactive,
+            plural(inactive)))
+
+# Add a server to a channel
+def add_server(irc, server, channel):
     if type(server) != str:
         server = server[0]
-    if server not in servers:
-        servers[server] = set()
-        irc.msg(server, 'players - If you are a human, report this to luk3yx.')
+    with _lock:
+        chan = _get_channel(channel)
+        if server in chan.unconfirmed:
+            # Refresh the player list of servers loaded from state_file.
+            chan.unconfirmed.discard(server)
+        elif not _add_to_channel(channel, server):
+            return
+    irc.msg(server, 'players - If you are a human, report this to luk3yx.')
 
 # Handle WHO replies
 @miniirc.Handler('352')
 def _handle_who(irc, hostmask, args):
     nick, status = args[-3:-1]
     if '+' in status:
-        add_server(irc, nick)
+        add_server(irc, nick, args[1])
 
-# Hadle MODEs - This is primitive but should work
+# Handle WHOX replies (to "WHO #channel %cnf")
+@miniirc.Handler('354')
+def _handle_whox(irc, hostmask, args):
+    if len(args) < 4:
+        return
+    channel, nick, status = args[1], args[2], args[3].lstrip(':')
+    if '+' in status:
+        add_server(irc, nick, channel)
+
+# Forget servers loaded from state_file that weren't in the WHO reply.
+@miniirc.Handler('315')
+def _handle_who_end(irc, hostmask, args):
+    with _lock:
+        chan = _channels.get(args[1].lower())
+        if chan is None or not chan.unconfirmed:
+            return
+        for server in tuple(chan.unconfirmed):
+            _remove_from_channel(args[1], server)
+
+# Get the channel modes that take parameters from ISUPPORT, returns (modes
+#   that always take a parameter, modes that only take one when set).
+def _get_mode_types(irc):
+    prefix = irc.isupport.get('PREFIX')
+    if isinstance(prefix, str) and prefix.startswith('(') and ')' in prefix:
+        prefix = prefix[1:prefix.index(')')]
+    else:
+        prefix = 'ov'
+
+    chanmodes = irc.isupport.get('CHANMODES')
+    if isinstance(chanmodes, str) and chanmodes.count(',') >= 2:
+        chanmodes = chanmodes.split(',')
+    else:
+        chanmodes = ('beI', 'k', 'l')
+    return prefix + chanmodes[0] + chanmodes[1], chanmodes[2]
+
+# Parse a channel MODE (including stacked modes like "+vv-o a b c"), returns
+#   a list of (adding, mode, parameter) tuples. parameter is None if the mode
+#   doesn't take one (or it is missing).
+def parse_modes(irc, args):
+    always, when_set = _get_mode_types(irc)
+    params = iter(args[2:])
+    adding = True
+    res = []
+    for mode in args[1]:
+        if mode in '+-':
+            adding = mode == '+'
+            continue
+        param = None
+        if mode in always or (adding and mode in when_set):
+            param = next(params, None)
+        res.append((adding, mode, param))
+    return res
+
+# Handle MODEs, voiced users are Minetest servers.
 @miniirc.Handler('MODE')
 def _handle_mode(irc, hostmask, args):
-    if len(args) < 3 or not args[0].startswith('#'):
+    if len(args) < 3 or args[0][:1] not in irc.isupport.get('CHANTYPES',
+            '#&'):
         return
-    if args[1] == '+v':
-        add_server(irc, args[2])
-    elif args[1].startswith('+') and 'v' in args[1]:
-        # Don't bother handling this and just send a WHO
-        irc.quote('WHO', args[0])
+    if args[-1].startswith(':'):
+        args = args[:-1] + [args[-1][1:]]
+
+    for adding, mode, param in parse_modes(irc, args):
+        if mode != 'v':
+            continue
+        elif not param:
+            # The MODE couldn't be parsed properly, refresh the channel.
+            request_who(irc, args[0])
+        elif adding:
+            add_server(irc, param, args[0])
+        else:
+            with _lock:
+                _remove_from_channel(args[0], param)
 
 # Handle JOIN of this bot
 @miniirc.Handler('JOIN')
 def _handle_join(irc, hostmask, args):
     if hostmask[0].lower() == irc.nick.lower():
-        irc.quote('WHO', args[0])
+        with _lock:
+            _get_channel(args[0])
+        request_who(irc, args[0])
+
+# Handle PARTs from MT servers (or this bot)
+@miniirc.Handler('PART')
+def _handle_part(irc, hostmask, args):
+    with _lock:
+        if hostmask[0].lower() == irc.nick.lower():
+            _remove_channel(args[0])
+        else:
+            _remove_from_channel(args[0], hostmask[0])
 
-# Handle PARTs and QUITs from MT servers
-@miniirc.Handler('PART', 'QUIT')
+# Handle QUITs from MT servers
+@miniirc.Handler('QUIT')
 def _handle_quit(irc, hostmask, args):
-    if hostmask[0] in servers:
-        del servers[hostmask[0]]
+    with _lock:
+        for channel in tuple(_server_channels.get(hostmask[0], ())):
+            _remove_from_channel(channel, hostmask[0])
 
 # Handle KICKs
 @miniirc.Handler('KICK')
 def _handle_kick(irc, hostmask, args):
-    if args[-2] in servers:
-        del servers[args[-2]]
+    with _lock:
+        if args[1].lower() == irc.nick.lower():
+            _remove_channel(args[0])
+        else:
+            _remove_from_channel(args[0], args[1])
 
-_irc.persist = True
-_irc.connect()
+if __name__ == '__main__':
+    load_state()
+    if state_file:
+        atexit.register(save_state)
+        threading.Thread(target=_state_writer, daemon=True).start()
+    threading.Thread(target=_sender, daemon=True).start()
+    threading.Thread(target=_who_sender, daemon=True).start()
+    _irc.persist = True
+    _irc.connect()
@@ -5,12 +5,78 @@
 # © 2018 by luk3yx
 #
 
-import miniirc, sys
+import ast, asyncio, bisect, hashlib, json, miniirc, multiprocessing.connection
+import os, pickle, re, select, signal, socketserver, ssl, stat, sys
+import threading, time
+from collections import deque, OrderedDict
 from miniirc import IRC
 
 # Variables
 debug    = True
 
+# The backend to use, 'threads' uses miniirc (with threads for every network)
+#   and 'asyncio' runs every network on one asyncio event loop.
+backend  = 'threads'
+
+# If workers is more than 1, networks are split between that many processes.
+#   Each process connects to its own networks and messages for other
+#   networks are sent to the process that owns them over a pipe. Metrics
+#   files and sockets get the worker number appended.
+workers  = 1
+
+# The amount of ignore verdicts to cache per network
+ignore_cache_size = 4096
+
+# Outgoing messages are queued per destination network. Up to send_burst
+#   messages can be sent at once, then one every send_interval seconds. When
+#   more than queue_limit messages are waiting, low priority messages are
+#   merged or dropped.
+send_burst    = 5
+send_interval = 1.0
+queue_limit   = 500
+
+# Messages for disconnected networks are written to spool_dir/<network>/ (if
+#   spool_dir is set) and replayed at the send rate after reconnecting.
+#   Segments are rotated every spool_segment_size bytes, the oldest segments
+#   are deleted when a spool is larger than spool_max_size bytes, and
+#   messages older than spool_max_age seconds are discarded. Writes are
+#   batched and fsynced at most once every spool_flush_interval seconds.
+spool_dir            = None
+spool_segment_size   = 1024 * 1024
+spool_max_size       = 64 * 1024 * 1024
+spool_max_age        = 86400
+spool_flush_interval = 1.0
+
+# The network list is reloaded from config_file (this file by default) on
+#   SIGHUP, or when it changes if watch_config is True. Only the networks
+#   dict is reloaded.
+config_file    = None
+watch_config   = False
+watch_interval = 5
+
+# If more than coalesce_threshold users join a channel (or quit in a
+#   netsplit) within coalesce_window seconds, the rest are relayed as one
+#   NETJOIN/NETSPLIT message per channel at the end of the window.
+coalesce_threshold = 5
+coalesce_window    = 5
+
+# Fingerprints of relayed messages are remembered for echo_window seconds
+#   (at most echo_cache_size of them), incoming messages that match one
+#   (with or without another relay's "<nick>" prefix) are not relayed again.
+echo_window     = 30
+echo_cache_size = 4096
+
+# Metrics (in the Prometheus text format) are written to metrics_file every
+#   metrics_interval seconds and/or sent to anything that connects to the
+#   UNIX socket metrics_socket.
+metrics_file     = None
+metrics_socket   = None
+metrics_interval = 15
+
+# Message priorities (lower numbers are sent first)
+priorities = {'PRIVMSG': 0, 'ACTION': 0, 'KICK': 1, 'NICK': 1, 'JOIN': 2,
+    'PART': 2, 'QUIT': 2}
+
 # Network list
 networks = {
 #   'Network Name': {
@@ -20,6 +86,8 @@ networks = {
 #       'ignored':  {'lowercase-identifier'}, # Matched against nick, ident
 #       '#channel': 'local-routing-name',     #     and host.
 #   },
+#   Ignore rules can also be hostmasks with wildcards, for example
+#       'ignored': {'*!*@*.bot.example', 'spammer!*@*'}
 }
 
 # Format strings
@@ -31,7 +99,10 @@ networks = {
 #     'KICK':    '<-- {victim} has been kicked by {kicker} ({msg})',
 #     'NICK':    ' -- {host[0]}@{network} ({host[1]}@{host[2]}) is now known as'
 #         '{msg}',
-#     'QUIT':    '<-- {victim} ({host[1]}@{host[2]}) has quit ({msg})'
+#     'QUIT':    '<-- {victim} ({host[1]}@{host[2]}) has quit ({msg})',
+#     'NETSPLIT': '<-- Netsplit on {network} ({msg}): {count} more users '
+#         'quit',
+#     'NETJOIN':  '--> Netjoin on {network}: {count} more users joined',
 # }
 
 # This looks messy, but it creates nice coloured/colored strings.
@@ -49,12 +120,176 @@ formatstrings = {
         _uh.format(), '').replace('{host[0]}', '{victim}'),
     'NICK':    _.format(6, ' --', '{NICK}').replace('({msg})',
         '{msg}').replace('has {NICK}', 'is now known as'),
-    'QUIT':    _.format(4, '<--', 'quit IRC')
+    'QUIT':    _.format(4, '<--', 'quit IRC'),
+    'NETSPLIT': '\x034<--\x03 Netsplit on {network} \x036(\x0310{msg}\x036)'
+        '\x034: {count} more users quit',
+    'NETJOIN': '\x033-->\x03 Netjoin on {network}\x033: {count} more '
+        'users joined',
 }
 del _
 del _hn
 del _uh
 
+# A minimal asyncio IRC client with the parts of miniirc.IRC that the relay
+#   uses. This must be created inside the event loop.
+class AsyncIRC:
+    connected = None
+    msglen = 512
+    ping_interval = 60
+
+    def debug(self, *args, **kwargs):
+        if self._debug:
+            print(*args, **kwargs)
+
+    def quote(self, *msg, force=None):
+        if self._writer is None or (not self.connected and not force):
+            self.debug('>Q>', *msg)
+            return
+        self.debug('>>>', *msg)
+        msg = (' '.join(msg).replace('\x00', '\ufffd').encode('utf-8')
+            .replace(b'\r', b' ').replace(b'\n', b' '))
+        if len(msg) + 2 > self.msglen:
+            msg = msg[:self.msglen - 2].decode('utf-8', 'ignore').encode(
+                'utf-8')
+        self._writer.write(msg + b'\r\n')
+
+    def msg(self, target, *msg):
+        self.quote('PRIVMSG', target, ':' + ' '.join(msg))
+
+    def disconnect(self, msg=None):
+        self.persist = False
+        self.quote('QUIT', ':' + (msg or 'I grew sick and died.'), force=True)
+        if self._writer is not None:
+            self._writer.close()
+
+    # Handle messages that miniirc would normally handle.
+    def _handle_builtin(self, cmd, args):
+        if cmd == 'PING':
+            self.quote('PONG', *args, force=True)
+        elif cmd == 'PONG':
+            self._pinged = False
+        elif cmd == '001':
+            self.connected = True
+            self.nick = args[0]
+            self.isupport.clear()
+            if self.ns_identity:
+                self.msg('NickServ', 'identify ' + self.ns_identity)
+            if self.channels:
+                self.quote('JOIN', ','.join(self.channels))
+        elif cmd == '005':
+            for token in args[1:-1]:
+                key, _, value = token.partition('=')
+                try:
+                    value = int(value)
+                except ValueError:
+                    pass
+                self.isupport[key] = value
+        elif cmd in ('432', '433') and not self.connected:
+            self.nick += '_'
+            self.quote('NICK', self.nick, force=True)
+
+    def _handle(self, line):
+        self.debug('<<<', line)
+        try:
+            cmd, hostmask, tags, args = miniirc.ircv3_message_parser(line)
+        except Exception:
+            return
+        cmd = cmd.upper()
+        self._handle_builtin(cmd, args)
+        if args and args[-1].startswith(':'):
+            args[-1] = args[-1][1:]
+        for handler in _handlers.get(cmd, ()):
+            try:
+                handler(self, hostmask, list(args))
+            except Exception as e:
+                print('Error in handler {!r}: {!r}'.format(handler, e),
+                    file=sys.stderr)
+
+    # Read a line, lines longer than the StreamReader's limit are dropped.
+    #   self._dropping is used so that this can be cancelled by wait_for().
+    async def _readline(self, reader):
+        while True:
+            try:
+                line = await reader.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                return b'' if self._dropping else e.partial
+            except asyncio.LimitOverrunError as e:
+                await reader.readexactly(e.consumed)
+                self._dropping = True
+                continue
+            if not self._dropping:
+                return line
+            self._dropping = False
+            self.debug('Dropped an over-long line.')
+
+    async def _main(self):
+        while self.persist:
+            self.connected = False
+            try:
+                ctx = ssl.create_default_context() if self.ssl else None
+                reader, self._writer = await asyncio.open_connection(self.ip,
+                    self.port, ssl=ctx)
+            except OSError as e:
+                self.debug('Failed to connect:', repr(e))
+                self.connected = None
+                await asyncio.sleep(5)
+                continue
+
+            self.quote('USER', self.ident, '0', '*', ':' + self.realname,
+                force=True)
+            self.quote('NICK', self.nick, force=True)
+            self._pinged = self._dropping = False
+            try:
+                while True:
+                    try:
+                        line = await asyncio.wait_for(self._readline(reader),
+                            self.ping_interval)
+                    except asyncio.TimeoutError:
+                        if self._pinged:
+                            raise
+                        self._pinged = True
+                        self.quote('PING', ':relay-ping', force=True)
+                        continue
+                    if not line:
+                        break
+                    line = line.decode('utf-8', 'replace').rstrip('\r\n')
+                    if line:
+                        self._handle(line)
+            except (OSError, asyncio.TimeoutError) as e:
+                self.debug('Lost connection!', repr(e))
+            finally:
+                self.connected = None
+                self._writer.close()
+                self._writer = None
+            if self.persist:
+                await asyncio.sleep(5)
+
+    def __init__(self, ip, port, nick, channels=None, *, ssl=None, ident=None,
+            realname=None, ns_identity=None, debug=False):
+        self.ip = ip
+        self.port = int(port)
+        self.nick = nick
+        self.channels = set(channels or ())
+        self.ident = ident or nick
+        self.realname = realname or nick
+        self.ssl = self.port == 6697 if ssl is None else ssl
+        self.ns_identity = ns_identity
+        self.isupport = {}
+        self.persist = True
+        self._debug = debug
+        self._writer = None
+        self._pinged = self._dropping = False
+        self._task = asyncio.get_running_loop().create_task(self._main())
+
+# Register a handler for both miniirc and AsyncIRC.
+_handlers = {}
+def Handler(*events):
+    def add_handler(func):
+        for event in events:
+            _handlers.setdefault(event.upper(), []).append(func)
+        return miniirc.Handler(*events, colon=False)(func)
+    return add_handler
+
 # Welcome!
 print('Welcome to miniirc-relay!', file=sys.stderr)
 is_channel = lambda channel : type(channel) == str and not channel[:1].isalnum()
@@ -62,14 +297,42 @@ is_channel = lambda channel : type(channel) == str and not channel[:1].isalnum()
 # Parse the networks list and connect to any new IRC networks
 _ircs   = {}
 relayed = {}
-def parse_networks():
-    print('Parsing networks...', file=sys.stderr)
-    relayed.clear()
+
+# The route table, {IRC: {'#channel': ((IRC, '#target'), ...)}}. This is
+#   rebuilt (and replaced) by parse_networks() and should not be modified.
+_routes = {}
+
+# Every relayed channel on every other network, {IRC: ((IRC, '#channel'), ...)}
+_broadcast = {}
+
+def _build_routes():
+    global _routes, _broadcast
+    routes = {}
+    for id, chans in relayed.items():
+        for name, channel in chans.items():
+            irc = networks[name].get(IRC)
+            if irc:
+                routes.setdefault(irc, {})[channel] = tuple(
+                    (networks[n][IRC], chans[n]) for n in chans
+                    if n != name and networks[n].get(IRC))
+
+    broadcast = {}
     for name in networks:
-        network = networks[name]
+        irc = networks[name].get(IRC)
+        if irc:
+            broadcast[irc] = tuple((networks[n][IRC], channel)
+                for n in networks if n != name and networks[n].get(IRC)
+                for channel in networks[n] if is_channel(channel))
 
-        channels = set()
-        for channel in network:
+    _routes, _broadcast = routes, broadcast
+
+# Get the relayed channels ({id: {network: '#channel'}}) for a networks dict,
+#   channel names are lowercased in place.
+def get_relayed(nets):
+    new_relayed = {}
+    for name in nets:
+        network = nets[name]
+        for channel in tuple(network):
             if is_channel(channel):
                 lchan = channel.lower()
                 if channel != lchan:
@@ -77,66 +340,1027 @@ def parse_networks():
                     del network[channel]
                     channel = lchan
                 del lchan
-                channels.add(channel)
                 id = network[channel]
-                if id not in relayed:
-                    relayed[id] = {}
-                relayed[id][name] = channel
+                if id not in new_relayed:
+                    new_relayed[id] = {}
+                new_relayed[id][name] = channel
+    return new_relayed
+
+# new_relayed is passed in by worker processes so that it is only computed
+#   once.
+def parse_networks(new_relayed=None):
+    global relayed
+    print('Parsing networks...', file=sys.stderr)
+    if new_relayed is None:
+        new_relayed = get_relayed(networks)
+    for name in networks:
+        network = networks[name]
 
         if not network.get(IRC):
-            print('Connecting to {}...'.format(repr(name)), file=sys.stderr)
-            network[IRC] = IRC(network['ip'], network['port'], network['nick'],
-                channels, ns_identity = network.get('ns_identity'),
-                debug = debug)
-            network[IRC].debug('Channels on {}: {}'.format(repr(name),channels))
+            channels = {channel for channel in network if is_channel(channel)}
+            if workers > 1 and shard_of(name) != _shard:
+                network[IRC] = RemoteIRC(name, shard_of(name), channels)
+            else:
+                print('Connecting to {}...'.format(repr(name)),
+                    file=sys.stderr)
+                irc_class = AsyncIRC if backend == 'asyncio' else IRC
+                network[IRC] = irc_class(network['ip'], network['port'],
+                    network['nick'], channels,
+                    ns_identity = network.get('ns_identity'), debug = debug)
+                network[IRC].debug('Channels on {}: {}'.format(repr(name),
+                    channels))
             _ircs[network[IRC]] = name
+
+        if network.get('ignored') is not None:
+            set_ignored(name, network['ignored'])
+        else:
+            _ignore_matchers.pop(name, None)
+    relayed = new_relayed
+    _build_routes()
     print('Done.', file=sys.stderr)
 
+# Hot reloading
+_reload_lock = threading.Lock()
+_connection_keys = ('ip', 'port', 'nick', 'ns_identity')
+
+# Load the networks dict from a file without running it.
+def load_networks(path=None):
+    path = path or config_file or __file__
+    with open(path, 'r') as f:
+        tree = ast.parse(f.read(), path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name)
+                and target.id == 'networks' for target in node.targets):
+            return ast.literal_eval(node.value)
+    raise ValueError('No networks dict found in {!r}.'.format(path))
+
+def _disconnect(name):
+    irc = networks[name].get(IRC)
+    if irc is None:
+        return
+    print('Disconnecting from {}...'.format(repr(name)), file=sys.stderr)
+    irc.disconnect()
+    _ircs.pop(irc, None)
+    _welcomed.discard(irc)
+    q = _send_queues.pop(irc, None)
+    if q is not None:
+        q.close()
+    with _members_lock:
+        _members.pop(irc, None)
+
+# Apply a new networks dict, only reconnecting to networks where the
+#   connection details have changed and JOINing/PARTing changed channels.
+def reload_networks(new_networks, new_relayed=None):
+    start = time.monotonic()
+    with _reload_lock:
+        for name in tuple(networks):
+            if name not in new_networks:
+                _disconnect(name)
+                del networks[name]
+                _ignore_matchers.pop(name, None)
+
+        for name, network in new_networks.items():
+            network = {(k.lower() if is_channel(k) else k): v
+                for k, v in network.items()}
+            old = networks.get(name)
+            irc = old and old.get(IRC)
+            if irc and all(old.get(k) == network.get(k)
+                    for k in _connection_keys):
+                network[IRC] = irc
+                old_chans = {c for c in old if is_channel(c)}
+                new_chans = {c for c in network if is_channel(c)}
+                for channel in new_chans - old_chans:
+                    irc.channels.add(channel)
+                    irc.quote('JOIN', channel)
+                for channel in old_chans - new_chans:
+                    irc.channels.discard(channel)
+                    irc.quote('PART', channel)
+            elif old is not None:
+                _disconnect(name)
+            networks[name] = network
+
+        parse_networks(new_relayed)
+    print('Reloaded networks in {:.3f} seconds.'.format(time.monotonic() -
+        start), file=sys.stderr)
+
+def reload_config(*args):
+    try:
+        reload_networks(load_networks())
+    except Exception as e:
+        print('Error reloading networks: {}: {}'.format(type(e).__name__, e),
+            file=sys.stderr)
+
+def _config_mtime():
+    try:
+        return os.stat(config_file or __file__).st_mtime
+    except OSError:
+        return None
+
+# Compiled ignore rules for a network. Rules without "!" or "@" are matched
+#   against the nick, ident and host like before, other rules are
+#   nick!ident@host masks with * and ? wildcards.
+class IgnoreMatcher:
+    __slots__ = ('source', 'rules', 'regex', 'cache', 'hits', '_lock')
+
+    @staticmethod
+    def _compile_mask(mask):
+        if '!' not in mask and '@' not in mask:
+            mask = re.escape(mask)
+            return ('{0}![^!]*@.*'.format(mask), '[^!]*!{0}@.*'.format(mask),
+                '[^!]*![^@]*@{0}'.format(mask))
+        if '!' not in mask:
+            mask = '*!' + mask
+        if '@' not in mask:
+            mask += '@*'
+        return (re.escape(mask).replace(r'\*', '.*').replace(r'\?', '.'),)
+
+    # Returns the rule that matches hostmask, or None.
+    def match(self, hostmask):
+        with self._lock:
+            try:
+                rule = self.cache[hostmask]
+            except KeyError:
+                pass
+            else:
+                self.cache.move_to_end(hostmask)
+                if rule is not None:
+                    self.hits[rule] += 1
+                return rule
+
+        m = self.regex and self.regex.fullmatch('{}!{}@{}'.format(*hostmask))
+        rule = self.rules[int(m.lastgroup[1:])] if m else None
+        with self._lock:
+            self.cache[hostmask] = rule
+            if len(self.cache) > ignore_cache_size:
+                self.cache.popitem(last=False)
+            if rule is not None:
+                self.hits[rule] += 1
+        return rule
+
+    def __init__(self, rules):
+        self.source = frozenset(rules or ())
+        self.rules = []
+        patterns = []
+        for rule in rules or ():
+            for pattern in self._compile_mask(rule.lower()):
+                patterns.append('(?P<r{}>{})'.format(len(self.rules), pattern))
+                self.rules.append(rule)
+        self.regex = patterns and re.compile('|'.join(patterns),
+            re.IGNORECASE | re.DOTALL)
+        self.cache = OrderedDict()
+        self.hits = dict.fromkeys(rules or (), 0)
+        self._lock = threading.Lock()
+
+# A set of ignore rules that forgets its matcher when it is changed in place.
+class IgnoreList(set):
+    __slots__ = ('matcher',)
+
+    def __init__(self, rules=()):
+        super().__init__(rules)
+        self.matcher = None
+
+def _invalidates_matcher(name):
+    method = getattr(set, name)
+    def wrapper(self, *args):
+        res = method(self, *args)
+        self.matcher = None
+        return res
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ('add', 'clear', 'discard', 'pop', 'remove', 'update',
+        'difference_update', 'intersection_update',
+        'symmetric_difference_update', '__ior__', '__iand__', '__isub__',
+        '__ixor__'):
+    setattr(IgnoreList, _name, _invalidates_matcher(_name))
+del _name
+
+_ignore_matchers = {}
+
+# Change the ignore list of a network, the verdict cache is cleared if the
+#   rules have changed. Returns the new IgnoreMatcher.
+def set_ignored(network, rules):
+    if not isinstance(rules, IgnoreList):
+        rules = IgnoreList(rules or ())
+    matcher = _ignore_matchers.get(network)
+    if matcher is None or matcher.source != rules:
+        matcher = _ignore_matchers[network] = IgnoreMatcher(rules)
+    rules.matcher = matcher
+    networks[network]['ignored'] = rules
+    return matcher
+
+# Get the amount of ignored events for every rule of a network.
+def get_ignore_hits(network):
+    matcher = _ignore_matchers.get(network)
+    return dict(matcher.hits) if matcher else {}
+
 # Check to see if a user is ignored.
 def is_ignored(hostmask, network):
-    if not networks.get(network) or not networks[network].get('ignored'):
+    if not networks.get(network):
         return
-    for name in hostmask:
-        if name.lower() in networks[network]['ignored']:
-            networks[network][IRC].debug('Ignoring message from ' +
-                repr(hostmask))
-            return True
+    rules = networks[network].get('ignored')
+    if not rules:
+        return
+
+    # IgnoreLists forget their matcher when changed, and other objects
+    #   (lists replaced with a plain set) don't have one.
+    matcher = getattr(rules, 'matcher', None)
+    if matcher is None:
+        matcher = set_ignored(network, rules)
+
+    if matcher.match(hostmask) is not None:
+        count('relay_ignored_total', network)
+        networks[network][IRC].debug('Ignoring message from ' +
+            repr(hostmask))
+        return True
     return False
 
-# Send a message to networks
-def relay_message(irc, msg, channel=None):
+# A token bucket used to pace outgoing messages
+class TokenBucket:
+    __slots__ = ('burst', 'interval', 'tokens', 'last')
+
+    # Returns the amount of seconds to wait before a token is available.
+    def delay(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.last) / self.interval)
+        self.last = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) * self.interval
+
+    def take(self):
+        self.tokens -= 1
+
+    def __init__(self, burst, interval):
+        self.burst = burst
+        self.interval = interval
+        self.tokens = burst
+        self.last = time.monotonic()
+
+# An append-only on-disk message queue made of numbered segment files. Items
+#   are [monotonic time, target, msg] lists, the time is stored as a UNIX
+#   timestamp so that it survives restarts.
+class Spool:
+    __slots__ = ('path', 'sizes', 'buffer', 'cond', '_next', '_file',
+        '_write_segment', '_read_file', '_read_pos', '_pops', '_write_lock',
+        '_writing', 'written', 'replayed', 'expired', 'dropped')
+
+    def _segment(self, n):
+        return os.path.join(self.path, '{:08d}.spool'.format(n))
+
+    def append(self, item):
+        with self.cond:
+            self.buffer.append([time.time() - time.monotonic() + item[0],
+                item[1], item[2]])
+            self.cond.notify()
+
+    # Returns True if there are messages that haven't been written to disk
+    #   yet (see flush()).
+    def unwritten(self):
+        return bool(self.buffer) or self._writing
+
+    # Returns True if there are messages on disk that have not been replayed.
+    def pending(self):
+        with self.cond:
+            if len(self.sizes) > 1:
+                return True
+            for size in self.sizes.values():
+                return self._read_pos < size
+            return False
+
+    # Remember the read position so that a restart doesn't replay
+    #   everything again.
+    def _save_position(self):
+        self._pops = 0
+        fn = os.path.join(self.path, 'position')
+        with open(fn + '.tmp', 'w') as f:
+            f.write('{} {}'.format(next(iter(self.sizes), 0), self._read_pos))
+        os.replace(fn + '.tmp', fn)
+
+    def _load_position(self):
+        try:
+            with open(os.path.join(self.path, 'position')) as f:
+                segment, pos = map(int, f.read().split())
+        except (OSError, ValueError):
+            return
+        if segment == next(iter(self.sizes), None):
+            self._read_pos = pos
+
+    def _remove_oldest(self):
+        n = next(iter(self.sizes))
+        if self._read_file is not None:
+            self._read_file.close()
+            self._read_file = None
+        self._read_pos = 0
+        del self.sizes[n]
+        try:
+            os.remove(self._segment(n))
+        except FileNotFoundError:
+            pass
+
+    # Get the next message, or None if there aren't any on disk.
+    def pop(self):
+        with self.cond:
+            while self.sizes:
+                n, size = next(iter(self.sizes.items()))
+                if self._read_pos >= size:
+                    # Keep the segment that is currently being written to.
+                    if self._file is not None and n == self._write_segment:
+                        if self._pops:
+                            self._save_position()
+                        return None
+                    self._remove_oldest()
+                    self._save_position()
+                    continue
+
+                if self._read_file is None:
+                    self._read_file = open(self._segment(n), 'rb')
+                    self._read_file.seek(self._read_pos)
+                line = self._read_file.readline()
+                if not line.endswith(b'\n'):
+                    # Truncated segment
+                    self._read_pos = size
+                    continue
+                self._read_pos += len(line)
+                self._pops += 1
+
+                # pop() isn't called again once the spool is empty, so the
+                #   position is saved when the end of a segment is reached.
+                if self._pops >= 64 or self._read_pos >= size:
+                    self._save_position()
+
+                try:
+                    ts, target, msg = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                age = time.time() - ts
+                if spool_max_age and age > spool_max_age:
+                    self.expired += 1
+                    continue
+                self.replayed += 1
+                return [time.monotonic() - age, target, msg]
+            return None
+
+    # Delete old segments if the spool is too large or they have expired.
+    def _trim(self):
+        while len(self.sizes) > 1 and sum(self.sizes.values()) > \
+                spool_max_size:
+            self._remove_oldest()
+            self.dropped += 1
+
+        if not spool_max_age:
+            return
+        limit = time.time() - spool_max_age
+        while len(self.sizes) > 1:
+            try:
+                if os.path.getmtime(self._segment(next(iter(self.sizes)))) \
+                        >= limit:
+                    break
+            except OSError:
+                pass
+            self._remove_oldest()
+            self.dropped += 1
+
+    # Write buffered messages to disk, waiting for spool_flush_interval
+    #   seconds first so that multiple messages share one fsync().
+    def _writer(self):
+        while True:
+            with self.cond:
+                while not self.buffer:
+                    self.cond.wait()
+            time.sleep(spool_flush_interval)
+            self.flush()
+
+    # Write buffered messages to disk now (after any write that is already
+    #   in progress). self.cond isn't held while writing, readers only read
+    #   up to the size in self.sizes which is updated afterwards.
+    def flush(self):
+        with self._write_lock:
+            old_file = None
+            with self.cond:
+                if not self.buffer:
+                    return
+                batch, self.buffer = self.buffer, []
+                self._writing = True
+                if self._file is None or self.sizes.get(self._write_segment,
+                        spool_segment_size) >= spool_segment_size:
+                    old_file = self._file
+                    self._write_segment = self._next
+                    self._next += 1
+                    self._file = open(self._segment(self._write_segment),
+                        'ab')
+                    self.sizes[self._write_segment] = 0
+                f, segment = self._file, self._write_segment
+
+            data = b''
+            try:
+                if old_file is not None:
+                    old_file.close()
+                data = b''.join(json.dumps(item).encode('utf-8') + b'\n'
+                    for item in batch)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                with self.cond:
+                    self.sizes[segment] += len(data)
+                    self.written += len(batch)
+                    self._writing = False
+                    self._trim()
+
+    def stats(self):
+        return {'size': sum(self.sizes.values()), 'segments': len(self.sizes),
+            'written': self.written, 'replayed': self.replayed,
+            'expired': self.expired, 'dropped': self.dropped}
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        segments = sorted(int(fn[:-6]) for fn in os.listdir(path)
+            if fn.endswith('.spool') and fn[:-6].isdigit())
+        self.sizes = OrderedDict((n, os.path.getsize(self._segment(n)))
+            for n in segments)
+        self.buffer = []
+        self.cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._writing = False
+        self._next = segments[-1] + 1 if segments else 1
+        self._file = self._write_segment = self._read_file = None
+        self._read_pos = self._pops = 0
+        self.written = self.replayed = self.expired = self.dropped = 0
+        self._load_position()
+        threading.Thread(target=self._writer, daemon=True).start()
+
+# Returns True once the bot has joined a channel since connecting. miniirc
+#   identifies with NickServ and sends JOINs in its 001 handler, so messages
+#   sent before this could be rejected by +n channels.
+def _is_ready(irc):
+    return irc.connected and bool(_members.get(irc))
+
+# Outgoing message queues, with one sender thread per destination.
+class SendQueue:
+    __slots__ = ('irc', 'queues', 'depth', 'cond', 'bucket', 'sent',
+        'dropped', 'merged', 'wait_total', 'wait_max', 'closed', 'spool')
+
+    def put(self, target, msg, priority=0):
+        if self.spool is not None and not self.irc.connected:
+            # Spool older queued messages first to keep them in order.
+            with self.cond:
+                self._spool_queued()
+                self.spool.append([time.monotonic(), target, msg])
+            return
+        with self.cond:
+            self.queues[priority].append([time.monotonic(), target, msg])
+            self.depth += 1
+            if self.depth > queue_limit:
+                self._trim()
+            self.cond.notify()
+
+    # Merge or drop the lowest priority message.
+    def _trim(self):
+        for q in reversed(self.queues):
+            if not q:
+                continue
+            elif len(q) > 1 and q[0][1] == q[1][1] and q is not self.queues[0]:
+                msg = q[0][2] + ' | ' + q[1][2]
+                if len(msg.encode('utf-8')) <= 400:
+                    q[1][0] = q[0][0]
+                    q[1][2] = msg
+                    q.popleft()
+                    self.merged += 1
+                    self.depth -= 1
+                    return
+            q.popleft()
+            self.dropped += 1
+            self.depth -= 1
+            return
+
+    def _get(self):
+        if self.spool is not None:
+            item = self.spool.pop()
+            if item is not None:
+                return item
+        for q in self.queues:
+            if q:
+                self.depth -= 1
+                return q.popleft()
+
+    def _send(self, item):
+        self.bucket.take()
+        self.irc.msg(item[1], item[2])
+
+        wait = time.monotonic() - item[0]
+        observe_latency(_ircs.get(self.irc), wait)
+        self.sent += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    # Wake the sender up after joining a channel.
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    # Stop the sender and discard any queued messages.
+    def close(self):
+        with self.cond:
+            self.closed = True
+            for q in self.queues:
+                q.clear()
+            self.depth = 0
+            self.cond.notify_all()
+
+    # Move queued messages to the spool (if any).
+    def _spool_queued(self):
+        if self.spool is None or not self.depth:
+            return
+        items = sorted(item for q in self.queues for item in q)
+        for q in self.queues:
+            q.clear()
+        self.depth = 0
+        for item in items:
+            self.spool.append(item)
+
+    def _idle(self):
+        return not self.depth and not self.closed and not (self.spool is not
+            None and self.spool.pending())
+
+    def _run(self):
+        while not self.closed:
+            with self.cond:
+                while self._idle():
+                    self.cond.wait(None if self.spool is None else 1)
+
+            # Wait for the network to connect (wake() is called when the bot
+            #   joins a channel) and for the flood limit.
+            with self.cond:
+                while not _is_ready(self.irc) and not self.closed:
+                    self._spool_queued()
+                    self.cond.wait()
+
+            # Messages spooled while disconnected are older than anything
+            #   that has been queued since, so write them to disk to be
+            #   replayed first.
+            if self.spool is not None and self.spool.unwritten():
+                self.spool.flush()
+            delay = self.bucket.delay()
+            if delay:
+                time.sleep(delay)
+                continue
+
+            with self.cond:
+                item = self._get()
+            if item is not None:
+                self._send(item)
+
+    def _start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stats(self):
+        res = {'depth': self.depth, 'sent': self.sent,
+            'dropped': self.dropped, 'merged': self.merged,
+            'wait_avg': self.wait_total / self.sent if self.sent else 0,
+            'wait_max': self.wait_max}
+        if self.spool is not None:
+            res['spool'] = self.spool.stats()
+        return res
+
+    def __init__(self, irc, spool=None):
+        self.irc = irc
+        self.spool = spool
+        self.queues = tuple(deque() for i in range(max(priorities.values())
+            + 1))
+        self.depth = self.sent = self.dropped = self.merged = 0
+        self.wait_total = self.wait_max = 0
+        self.cond = threading.Condition()
+        self.bucket = TokenBucket(send_burst, send_interval)
+        self.closed = False
+        self._start()
+
+# The asyncio version of SendQueue, this must be created inside the event
+#   loop.
+class AsyncSendQueue(SendQueue):
+    __slots__ = ('event',)
+
+    def put(self, target, msg, priority=0):
+        super().put(target, msg, priority)
+        self.event.set()
+
+    def wake(self):
+        self.event.set()
+
+    def close(self):
+        super().close()
+        self.event.set()
+
+    async def _run_async(self):
+        while not self.closed:
+            while self._idle():
+                self.event.clear()
+                try:
+                    await asyncio.wait_for(self.event.wait(),
+                        None if self.spool is None else 1)
+                except asyncio.TimeoutError:
+                    pass
+
+            while not _is_ready(self.irc) and not self.closed:
+                self._spool_queued()
+                self.event.clear()
+                await self.event.wait()
+
+            if self.spool is not None and self.spool.unwritten():
+                await asyncio.get_running_loop().run_in_executor(None,
+                    self.spool.flush)
+            delay = self.bucket.delay()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+
+            item = self._get()
+            if item is not None:
+                self._send(item)
+
+    def _start(self):
+        self.event = asyncio.Event()
+        asyncio.get_running_loop().create_task(self._run_async())
+
+_send_queues = {}
+_send_queues_lock = threading.Lock()
+
+def send(irc, target, msg, priority=0):
+    if irc.__class__ is RemoteIRC:
+        return irc.put(target, msg, priority)
+    q = _send_queues.get(irc)
+    if q is None:
+        with _send_queues_lock:
+            q = _send_queues.get(irc)
+            if q is None:
+                spool = None
+                if spool_dir:
+                    spool = Spool(os.path.join(spool_dir, re.sub(r'[^\w.-]',
+                        '_', _ircs.get(irc, 'unknown'))))
+                q = _send_queues[irc] = (AsyncSendQueue if
+                    isinstance(irc, AsyncIRC) else SendQueue)(irc, spool)
+    q.put(target, msg, priority)
+
+# Get the queue statistics for every network.
+def queue_stats():
+    return {_ircs.get(irc): q.stats() for irc, q in _send_queues.items()}
+
+# Remembers recently relayed messages so that they aren't relayed again if
+#   another relay (or a bridge) sends them back. Messages are normalised
+#   (formatting removed, whitespace collapsed and lowercased) and only their
+#   hash is stored in a fixed-size ring.
+_formatting_re = re.compile(r'\x03(?:\d{1,2}(?:,\d{1,2})?)?|'
+    r'[\x02\x0f\x11\x16\x1d\x1e\x1f]')
+_relay_prefix_re = re.compile(r'^(?:<[^>]*>|\[[^\]]*\]|\* ?\S+):? ')
+class EchoFilter:
+    __slots__ = ('window', 'ring', 'pos', 'expiry', 'lock', 'suppressed')
+
+    @staticmethod
+    def normalise(text):
+        return ' '.join(_formatting_re.sub('', text).split()).lower()
+
+    def add(self, msg):
+        fp = hash(self.normalise(msg))
+        expiry = time.monotonic() + self.window
+        with self.lock:
+            # Overwrite the oldest entry.
+            old = self.ring[self.pos]
+            if old is not None and self.expiry.get(old[0]) == old[1]:
+                del self.expiry[old[0]]
+            self.ring[self.pos] = (fp, expiry)
+            self.pos = (self.pos + 1) % len(self.ring)
+            self.expiry[fp] = expiry
+
+    # Returns True if text is (or ends with) a recently relayed message.
+    def is_echo(self, text):
+        text = self.normalise(text)
+        now = time.monotonic()
+        for fp in (hash(text), hash(_relay_prefix_re.sub('', text, 1))):
+            if self.expiry.get(fp, 0) > now:
+                self.suppressed += 1
+                return True
+        return False
+
+    def __init__(self, window, size):
+        self.window = window
+        self.ring = [None] * size
+        self.pos = self.suppressed = 0
+        self.expiry = {}
+        self.lock = threading.Lock()
+
+echo_filter = EchoFilter(echo_window, echo_cache_size)
+
+_no_routes = {}
+
+# Relay a message to the routes of channel (or every route if channel is
+#   None). If text (the original message) is given, echoes are dropped.
+def relay_message(irc, msg, channel=None, priority=0, text=None):
     if not msg:
         return
-    network = _ircs.get(irc)
+    if text is not None and echo_filter.is_echo(text):
+        count('relay_echoes_total', _ircs.get(irc))
+        irc.debug('Dropping echo: ' + repr(text))
+        return
 
     if channel:
-        channel = channel.lower()
-        irc.debug('Sending message from', channel, 'on', network)
-        if not is_channel(channel) or channel not in networks[network]:
+        chans = _routes.get(irc, _no_routes)
+        routes = chans.get(channel)
+        if routes is None:
+            routes = chans.get(channel.lower(), ())
+    else:
+        routes = _broadcast.get(irc, ())
+
+    if routes:
+        echo_filter.add(msg)
+    net = _ircs.get(irc)
+    for peer, target in routes:
+        send(peer, target, msg, priority)
+        count('relay_relayed_total', net, channel or '', _ircs.get(peer),
+            target)
+    stats['sent'] += len(routes)
+
+# Send a message to every route of channels (used for QUITs and NICKs), each
+#   destination only gets the message once.
+def relay_to_channels(irc, msg, channels, priority=0):
+    if not msg:
+        return
+    chans = _routes.get(irc, _no_routes)
+    sent = set()
+    net = _ircs.get(irc)
+    for channel in channels:
+        for route in chans.get(channel, ()):
+            if route not in sent:
+                sent.add(route)
+                send(route[0], route[1], msg, priority)
+                count('relay_relayed_total', net, channel,
+                    _ircs.get(route[0]), route[1])
+    if sent:
+        echo_filter.add(msg)
+    stats['sent'] += len(sent)
+    stats['avoided'] += len(_broadcast.get(irc, ())) - len(sent)
+
+# Statistics, "avoided" is the amount of messages that would have been sent
+#   if QUITs and NICKs were relayed to every channel.
+stats = {'sent': 0, 'avoided': 0}
+
+# Channel membership, {IRC: {'#channel': {'casefolded-nick', ...}}}
+_members = {}
+_members_lock = threading.Lock()
+_rfc1459 = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~',
+    'abcdefghijklmnopqrstuvwxyz{}|^')
+_ascii = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+    'abcdefghijklmnopqrstuvwxyz')
+
+# Case-fold a nickname using the network's CASEMAPPING.
+def casefold(irc, nick):
+    if irc.isupport.get('CASEMAPPING') == 'ascii':
+        return sys.intern(nick.translate(_ascii))
+    return sys.intern(nick.translate(_rfc1459))
+
+def _is_me(irc, nick):
+    return casefold(irc, nick) == casefold(irc, irc.nick)
+
+def _add_member(irc, channel, nick):
+    with _members_lock:
+        chans = _members.setdefault(irc, {})
+        if _is_me(irc, nick):
+            chans[channel.lower()] = set()
+        else:
+            chans.setdefault(channel.lower(), set()).add(casefold(irc, nick))
+
+def _remove_member(irc, channel, nick):
+    with _members_lock:
+        chans = _members.get(irc)
+        if not chans:
             return
-        id = networks[network][channel]
-        if id not in relayed:
-            print('WARNING: Non-existent channel ID detected!', file=sys.stderr)
-            parse_networks()
-        to_relay = relayed[id]
-        for n in to_relay:
-            if n != network and networks[n].get(IRC):
-                irc.debug('Relaying from', network, 'to', n, 'via', networks[n][IRC])
-                networks[n][IRC].msg(to_relay[n], msg)
+        elif _is_me(irc, nick):
+            chans.pop(channel.lower(), None)
+        elif channel.lower() in chans:
+            chans[channel.lower()].discard(casefold(irc, nick))
+
+# Remove (or rename) a user in every channel, returning the channels the user
+#   was in.
+def _remove_user(irc, nick, new_nick=None):
+    nick = casefold(irc, nick)
+    if new_nick is not None:
+        new_nick = casefold(irc, new_nick)
+    res = []
+    with _members_lock:
+        for channel, members in _members.get(irc, _no_routes).items():
+            if nick in members:
+                res.append(channel)
+                members.remove(nick)
+                if new_nick is not None:
+                    members.add(new_nick)
+    return res
+
+# Get the amount of tracked channels, members and (approximate) bytes used.
+def membership_size():
+    channels = members = size = 0
+    with _members_lock:
+        for chans in _members.values():
+            size += sys.getsizeof(chans)
+            for channel, nicks in chans.items():
+                channels += 1
+                members += len(nicks)
+                size += sys.getsizeof(nicks)
+    return channels, members, size
+
+# Metrics, counters are stored as {(name, labels): value} and the latency
+#   histograms as {network: [bucket counts..., +Inf count, sum]}. These
+#   aren't locked, so with the threads backend an increment may very rarely
+#   be lost.
+_counters = {}
+_latency = {}
+latency_buckets = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+_metric_info = {
+    'relay_events_total': ('Events received.', ('network', 'type')),
+    'relay_relayed_total': ('Messages relayed per route.', ('network',
+        'channel', 'to_network', 'to_channel')),
+    'relay_ignored_total': ('Ignored events.', ('network',)),
+    'relay_echoes_total': ('Echoed messages that were dropped.',
+        ('network',)),
+    'relay_connects_total': ('Successful connections.', ('network',)),
+    'relay_reconnects_total': ('Successful reconnections.', ('network',)),
+}
+
+def count(name, *labels):
+    key = (name, labels)
+    _counters[key] = _counters.get(key, 0) + 1
+
+def observe_latency(network, seconds):
+    hist = _latency.get(network)
+    if hist is None:
+        hist = _latency[network] = [0] * (len(latency_buckets) + 2)
+    hist[bisect.bisect_left(latency_buckets, seconds)] += 1
+    hist[-1] += seconds
+
+def _labels(names, values):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\',
+        '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values))
+
+# Get every metric in the Prometheus text format.
+def format_metrics():
+    lines = []
+    counters = sorted(dict(_counters).items(), key=lambda i : (i[0][0],
+        tuple(map(str, i[0][1]))))
+    last = None
+    for (name, labels), value in counters:
+        help, names = _metric_info[name]
+        if name != last:
+            last = name
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} counter'.format(name))
+        lines.append('{}{{{}}} {}'.format(name, _labels(names, labels),
+            value))
+
+    name = 'relay_send_latency_seconds'
+    lines.append('# HELP {} Time between receiving and sending relayed '
+        'messages.'.format(name))
+    lines.append('# TYPE {} histogram'.format(name))
+    for network, hist in sorted(dict(_latency).items()):
+        hist = list(hist)
+        labels = _labels(('network',), (network,))
+        total = 0
+        for le, value in zip(latency_buckets + ('+Inf',), hist):
+            total += value
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels,
+                le, total))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, hist[-1]))
+        lines.append('{}_count{{{}}} {}'.format(name, labels, total))
+
+    gauges = (('relay_queue_depth', 'depth', 'Messages waiting to be sent.'),
+        ('relay_queue_dropped_total', 'dropped', 'Messages dropped from '
+        'send queues.'))
+    queues = sorted(queue_stats().items(), key=lambda i : str(i[0]))
+    for name, key, help in gauges:
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, 'counter' if
+            name.endswith('_total') else 'gauge'))
+        for network, q in queues:
+            lines.append('{}{{{}}} {}'.format(name, _labels(('network',),
+                (network,)), q[key]))
+
+    channels, members, size = membership_size()
+    lines.append('# HELP relay_members Tracked channel members.')
+    lines.append('# TYPE relay_members gauge')
+    lines.append('relay_members {}'.format(members))
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(path):
+    with open(path + '.tmp', 'w') as f:
+        f.write(format_metrics())
+    os.replace(path + '.tmp', path)
+
+class _MetricsHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(format_metrics().encode('utf-8'))
+
+class _MetricsServer(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def _metrics_writer():
+    while True:
+        time.sleep(metrics_interval)
+        try:
+            write_metrics(metrics_file)
+        except Exception as e:
+            print('Could not write metrics: {!r}'.format(e), file=sys.stderr)
+
+def start_metrics():
+    if metrics_socket:
+        try:
+            if stat.S_ISSOCK(os.stat(metrics_socket).st_mode):
+                os.remove(metrics_socket)
+        except FileNotFoundError:
+            pass
+        server = _MetricsServer(metrics_socket, _MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    if metrics_file:
+        threading.Thread(target=_metrics_writer, daemon=True).start()
+
+# Netsplit and join storm coalescing
+_bursts = {}
+_bursts_lock = threading.Lock()
+_split_re = re.compile(r'^[^ .]+\.[^ ]+ [^ .]+\.[^ ]+$')
+
+# Run func after delay seconds in the same thread as handlers.
+def _call_later(delay, func, *args):
+    if backend == 'asyncio':
+        asyncio.get_running_loop().call_later(delay, func, *args)
     else:
-        for n in networks:
-            if n != network and networks[n].get(IRC):
-                for channel in networks[n]:
-                    if is_channel(channel):
-                        networks[n][IRC].msg(channel, msg)
+        timer = threading.Timer(delay, func, args)
+        timer.daemon = True
+        timer.start()
 
+def _flush_burst(key):
+    with _bursts_lock:
+        burst = _bursts.pop(key, None)
+    if not burst or not burst[2]:
+        return
+    irc, event, channel = key
+    net = _ircs.get(irc)
+    if net:
+        fmt = 'NETSPLIT' if event == 'QUIT' else 'NETJOIN'
+        msg = formatstrings[fmt].format(network=net, msg=burst[3],
+            count=burst[2])
+        relay_message(irc, msg, channel, priorities[event])
+
+# Returns True if an event should be relayed normally, or False if it is part
+#   of a burst and will be included in a NETSPLIT/NETJOIN message instead.
+def coalesce(irc, event, channel, reason=''):
+    if not coalesce_threshold:
+        return True
+    key = (irc, event, channel)
+    now = time.monotonic()
+    with _bursts_lock:
+        burst = _bursts.get(key)
+        if burst is None:
+            # [start time, event count, held back events, reason]
+            burst = _bursts[key] = [now, 0, 0, reason]
+            _call_later(coalesce_window, _flush_burst, key)
+        burst[1] += 1
+        if burst[1] <= coalesce_threshold:
+            return True
+        burst[2] += 1
+        return False
+
+def is_netsplit(reason):
+    return bool(_split_re.match(reason))
+
+# Handle NAMES replies
+@Handler('353')
+def handle_names(irc, hostmask, args):
+    prefixes = irc.isupport.get('PREFIX', '(qaohv)~&@%+')
+    prefixes = prefixes[prefixes.find(')') + 1:]
+    for nick in args[-1].split(' '):
+        nick = nick.lstrip(prefixes)
+        if nick:
+            _add_member(irc, args[-2], nick)
+
+# Forget about channels when reconnecting
+_welcomed = set()
+@Handler('001')
+def handle_welcome(irc, hostmask, args):
+    with _members_lock:
+        _members.pop(irc, None)
+    net = _ircs.get(irc)
+    count('relay_connects_total', net)
+    if irc in _welcomed:
+        count('relay_reconnects_total', net)
+    _welcomed.add(irc)
 
 # Handle PRIVMSGs
-@miniirc.Handler('PRIVMSG', colon=False)
+@Handler('PRIVMSG')
 def handle_privmsg(irc, hostmask, args):
     text = args[-1]
     msg = None
     net = _ircs.get(irc)
+    count('relay_events_total', net, 'PRIVMSG')
     if is_ignored(hostmask, net):
         return
 
@@ -144,65 +1368,304 @@ def handle_privmsg(irc, hostmask, args):
       and text.endswith('\x01')):
         msg = formatstrings['ACTION'].format(host=hostmask, network=net,
             msg=text[8:-1])
+        priority = priorities['ACTION']
     elif not text.startswith('\x01'):
         msg = formatstrings['PRIVMSG'].format(host=hostmask, network=net,
             msg=text)
+        priority = priorities['PRIVMSG']
 
-    relay_message(irc, msg, args[0])
+    if msg:
+        relay_message(irc, msg, args[0], priority, text)
 
 # Handle JOINs
-@miniirc.Handler('JOIN', colon=False)
+@Handler('JOIN')
 def handle_join(irc, hostmask, args):
+    _add_member(irc, args[0], hostmask[0])
+    if _is_me(irc, hostmask[0]):
+        q = _send_queues.get(irc)
+        if q is not None:
+            q.wake()
     net = _ircs.get(irc)
+    count('relay_events_total', net, 'JOIN')
     if is_ignored(hostmask, net):
         return
-    if net:
+    if net and coalesce(irc, 'JOIN', args[0].lower()):
         msg = formatstrings['JOIN'].format(host=hostmask, network=net)
-        relay_message(irc, msg, args[0])
+        relay_message(irc, msg, args[0], priorities['JOIN'])
 
 # Handle PARTs
-@miniirc.Handler('PART', colon=False)
+@Handler('PART')
 def handle_part(irc, hostmask, args):
+    _remove_member(irc, args[0], hostmask[0])
     net = _ircs.get(irc)
+    count('relay_events_total', net, 'PART')
     if is_ignored(hostmask, net):
         return
     if net:
         msg = formatstrings['PART'].format(host=hostmask, network=net,
             msg=args[-1])
-        relay_message(irc, msg, args[0])
+        relay_message(irc, msg, args[0], priorities['PART'])
 
-# Handle PARTs
-@miniirc.Handler('KICK', colon=False)
-def handle_part(irc, hostmask, args):
+# Handle KICKs
+@Handler('KICK')
+def handle_kick(irc, hostmask, args):
+    _remove_member(irc, args[0], args[1])
     net = _ircs.get(irc)
+    count('relay_events_total', net, 'KICK')
     if is_ignored(hostmask, net):
         return
     if net:
         msg = formatstrings['KICK'].format(victim=args[-2], network=net,
             kicker=hostmask[0], msg=args[-1])
-        relay_message(irc, msg, args[0])
+        relay_message(irc, msg, args[0], priorities['KICK'])
 
 # Handle QUITs
-@miniirc.Handler('QUIT', colon=False)
+@Handler('QUIT')
 def handle_quit(irc, hostmask, args):
+    channels = _remove_user(irc, hostmask[0])
     net = _ircs.get(irc)
+    count('relay_events_total', net, 'QUIT')
     if is_ignored(hostmask, net):
         return
     if net:
+        reason = args[-1] if args else ''
+        if is_netsplit(reason):
+            channels = [channel for channel in channels
+                if coalesce(irc, 'QUIT', channel, reason)]
         msg = formatstrings['QUIT'].format(host=hostmask, network=net,
-            msg=args[-1] if args else '')
-        relay_message(irc, msg)
+            msg=reason)
+        relay_to_channels(irc, msg, channels, priorities['QUIT'])
 
 # Handle NICKs
-@miniirc.Handler('NICK', colon=False)
-def handle_quit(irc, hostmask, args):
+@Handler('NICK')
+def handle_nick(irc, hostmask, args):
+    channels = _remove_user(irc, hostmask[0], args[0])
     net = _ircs.get(irc)
+    count('relay_events_total', net, 'NICK')
     if is_ignored(hostmask, net):
         return
     if net:
         msg = formatstrings['NICK'].format(host=hostmask, network=net,
-            newnick=args[0])
-        relay_message(irc, msg)
+            newnick=args[0], msg=args[0])
+        relay_to_channels(irc, msg, channels, priorities['NICK'])
+
+# Worker processes
+_shard = None
+_bus = _bus_locks = ()
+_bus_max_size = select.PIPE_BUF - 4
+
+# Networks are assigned to workers by a hash of their name so that reloading
+#   never moves a network to a different process.
+def shard_of(name):
+    digest = hashlib.sha1(name.encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') % workers
+
+# A network that is connected to by another worker process, messages sent
+#   to it are passed to that process.
+class RemoteIRC:
+    __slots__ = ('name', 'shard', 'channels')
+    connected = True
+    isupport = {}
+
+    def debug(self, *args, **kwargs):
+        pass
+
+    def quote(self, *msg, force=None):
+        pass
+
+    def disconnect(self, msg=None):
+        pass
+
+    def msg(self, target, *msg):
+        self.put(target, ' '.join(msg))
+
+    # Every process shares the same pipe, so messages are truncated to make
+    #   them small enough (PIPE_BUF bytes including the 4 byte length
+    #   header) to be written atomically. Each pipe is only read by one
+    #   thread, which keeps messages in order.
+    def put(self, target, msg, priority=0):
+        data = pickle.dumps(('msg', self.name, target, msg, priority))
+        while len(data) > _bus_max_size and msg:
+            raw = msg.encode('utf-8')
+            msg = raw[:len(raw) - (len(data) - _bus_max_size)].decode(
+                'utf-8', 'ignore')
+            data = pickle.dumps(('msg', self.name, target, msg, priority))
+        if len(data) > _bus_max_size:
+            return
+        with _bus_locks[self.shard]:
+            _bus[self.shard].send_bytes(data)
+
+    def __init__(self, name, shard, channels):
+        self.name = name
+        self.shard = shard
+        self.channels = channels
+
+def _bus_receive(item):
+    if item[0] == 'msg':
+        network = networks.get(item[1])
+        irc = network and network.get(IRC)
+        if irc is not None and irc.__class__ is not RemoteIRC:
+            # Remember the message here too so that echoes coming back on
+            #   this worker's networks are recognised.
+            echo_filter.add(item[3])
+            send(irc, item[2], item[3], item[4])
+    elif item[0] == 'reload':
+        reload_networks(item[1], item[2])
+
+# Read messages from the other processes, returns when the parent process
+#   exits.
+def _bus_reader(conns):
+    while True:
+        for conn in multiprocessing.connection.wait(conns):
+            try:
+                item = conn.recv()
+                _bus_receive(item)
+            except EOFError:
+                return
+            except Exception as e:
+                print('Error handling bus message: {!r}'.format(e),
+                    file=sys.stderr)
+
+async def _bus_reader_async(conns):
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    def ready(conn):
+        try:
+            while conn.poll():
+                _bus_receive(conn.recv())
+        except EOFError:
+            if not done.done():
+                done.set_result(None)
+        except Exception as e:
+            print('Error handling bus message: {!r}'.format(e),
+                file=sys.stderr)
+    for conn in conns:
+        loop.add_reader(conn.fileno(), ready, conn)
+    await done
+
+# Disconnect from this worker's networks.
+def _disconnect_local():
+    for network in networks.values():
+        irc = network.get(IRC)
+        if irc is not None and irc.__class__ is not RemoteIRC:
+            irc.disconnect()
+
+async def _worker_async(conns, new_relayed):
+    parse_networks(new_relayed)
+    await _bus_reader_async(conns)
+    _disconnect_local()
+    await asyncio.sleep(0)
+
+def _worker(shard, data, control, new_relayed):
+    global _shard, _bus, _bus_locks, metrics_file, metrics_socket
+    _shard = shard
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    # Close the pipe ends that this process doesn't use.
+    for i in range(workers):
+        control[i][1].close()
+        if i != shard:
+            data[i][0].close()
+            control[i][0].close()
+    _bus = tuple(writer for reader, writer in data)
+    _bus_locks = tuple(threading.Lock() for i in range(workers))
+    conns = (data[shard][0], control[shard][0])
+
+    if metrics_file:
+        metrics_file += '.{}'.format(shard)
+    if metrics_socket:
+        metrics_socket += '.{}'.format(shard)
+    start_metrics()
+
+    if backend == 'asyncio':
+        asyncio.run(_worker_async(conns, new_relayed))
+    else:
+        parse_networks(new_relayed)
+        _bus_reader(conns)
+        _disconnect_local()
+
+    # The parent process has exited. miniirc's threads aren't daemon threads
+    #   and would keep the worker (and anything reading its output) running
+    #   forever, so exit without waiting for them.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)
+
+def _reload_workers(controls):
+    try:
+        new_networks = load_networks()
+        new_relayed = get_relayed(new_networks)
+    except Exception as e:
+        print('Error reloading networks: {}: {}'.format(type(e).__name__, e),
+            file=sys.stderr)
+        return
+    for conn in controls:
+        conn.send(('reload', new_networks, new_relayed))
+
+# Start the worker processes and handle reloads, this exits if any of them
+#   exit.
+def run_workers():
+    ctx = multiprocessing.get_context('fork')
+    new_relayed = get_relayed(networks)
+    data = [ctx.Pipe(duplex=False) for i in range(workers)]
+    control = [ctx.Pipe(duplex=False) for i in range(workers)]
+    procs = [ctx.Process(target=_worker, args=(i, data, control, new_relayed),
+        name='relay-worker-{}'.format(i), daemon=True)
+        for i in range(workers)]
+    for proc in procs:
+        proc.start()
+
+    for reader, writer in data:
+        reader.close()
+        writer.close()
+    controls = []
+    for reader, writer in control:
+        reader.close()
+        controls.append(writer)
+
+    signal.signal(signal.SIGHUP, lambda *args : _reload_workers(controls))
+    mtime = _config_mtime()
+    sentinels = [proc.sentinel for proc in procs]
+    while not multiprocessing.connection.wait(sentinels, watch_interval):
+        if watch_config and _config_mtime() != mtime:
+            mtime = _config_mtime()
+            _reload_workers(controls)
+
+    print('A worker process has exited, stopping.', file=sys.stderr)
+    for proc in procs:
+        proc.terminate()
+    sys.exit(1)
+
+async def _main_async():
+    parse_networks()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, reload_config)
+    mtime = _config_mtime()
+    while True:
+        await asyncio.sleep(watch_interval)
+        if watch_config and _config_mtime() != mtime:
+            mtime = _config_mtime()
+            reload_config()
 
 # Parse the network list
-parse_networks()
+def main():
+    if workers > 1:
+        return run_workers()
+
+    start_metrics()
+    if backend == 'asyncio':
+        return asyncio.run(_main_async())
+
+    parse_networks()
+
+    # Keep the main thread running so that SIGHUP can be handled.
+    signal.signal(signal.SIGHUP, reload_config)
+    mtime = _config_mtime()
+    while True:
+        time.sleep(watch_interval)
+        if watch_config and _config_mtime() != mtime:
+            mtime = _config_mtime()
+            reload_config()
+
+if __name__ == '__main__':
+    main()
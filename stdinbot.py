@@ -6,7 +6,8 @@
 # © 2018 by luk3yx
 #
 
-import sys, time
+import json, os, queue, socket, socketserver, stat, sys, threading, time
+from collections import deque, OrderedDict
 from miniirc import IRC
 
 # Variables
@@ -16,7 +17,6 @@ realname   = 'Reads stdin from a terminal'
 identity   = None
 # identity = '<username> <password>'
 print_cmds = False
-interval   = 0.25
 
 channels = ['#lurk']
 debug    = False
@@ -24,24 +24,693 @@ debug    = False
 ip = 'xeroxirc.net'
 port = 6697
 
+# Flood control: up to flood_burst messages can be sent at once, after that
+#   one message is sent every flood_interval seconds. If the server complains
+#   about flooding, the interval is doubled (up to max_interval) and slowly
+#   returns to flood_interval afterwards.
+flood_burst    = 5
+flood_interval = 1.0
+max_interval   = 10.0
+
+# Short lines are packed into one PRIVMSG (up to the 512 byte limit) and are
+#   separated with this string.
+separator      = ' | '
+
+# The amount of lines that can be waiting to be sent, and what to do when
+#   stdin is read faster than lines can be sent: 'block' stops reading stdin,
+#   'drop-oldest' discards the oldest waiting line and 'drop-newest' discards
+#   the line that was just read.
+queue_size     = 10000
+queue_policy   = 'block'
+
+# Consecutive copies of the same line are suppressed (if dedup_repeats is
+#   True), and "Last line repeated N times" is sent once a new line is read
+#   or after dedup_interval seconds. If dedup_window is more than 0, lines
+#   that have been seen anywhere in the last dedup_window lines are also
+#   suppressed.
+dedup_repeats  = True
+dedup_window   = 0
+dedup_interval = 30
+
+# If more than burst_threshold lines are waiting to be sent, all but the
+#   newest burst_keep lines are replaced with a summary. Set burst_threshold
+#   to 0 to disable this.
+burst_threshold = 1000
+burst_keep      = 10
+
+# Follow mode (./stdinbot.py <file>...): Files are read in chunks of
+#   read_size bytes and are checked for rotation/truncation every
+#   poll_interval seconds. The byte offset of the last sent line in each file
+#   is saved to offset_file (if set) so restarts continue where they left off.
+read_size      = 65536
+poll_interval  = 0.5
+offset_file    = None
+# offset_file = 'stdinbot-offsets.json'
+
+# Socket mode (./stdinbot.py --socket <path>): Newline-delimited JSON
+#   ({"target": "#channel", "text": "..."} or a list of these to submit a
+#   batch) is accepted from any amount of clients and sent over one IRC
+#   connection. queue_size and queue_policy apply to every client/target.
+socket_mode    = 0o660
+
+# Print throughput statistics to stderr every stats_interval seconds (0 to
+#   only print them when exiting).
+stats_interval = 60
+
 # Welcome!
 print("Welcome to stdinbot!", file=sys.stderr)
 irc = IRC(ip, port, nick, channels, ident=ident, realname=realname,
     ns_identity=identity, debug=debug, auto_connect=False)
 
-# Read stdin
-@irc.Handler('001')
-def handle_stdin(irc, hostmask, args):
-    qmsg = 'I reached the end of my file, therefore my life™.'
+# A token bucket that adapts to the server's flood allowance
+class TokenBucket:
+    __slots__ = ('burst', 'interval', 'min_interval', 'max_interval',
+        'tokens', 'last', '_lock')
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.last) / self.interval)
+        self.last = now
+
+    # Wait for a token to become available and take it
+    def take(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens < 1:
+                delay = (1 - self.tokens) * self.interval
+                time.sleep(delay)
+                self._refill(now + delay)
+            self.tokens -= 1
+
+    # The server is complaining, empty the bucket and back off.
+    def slow_down(self):
+        with self._lock:
+            self.interval = min(self.interval * 2, self.max_interval)
+            self.tokens = 0
+            self.last = time.monotonic()
+
+    # Slowly return to the configured interval.
+    def speed_up(self):
+        if self.interval > self.min_interval:
+            with self._lock:
+                self.interval = max(self.interval * 0.9, self.min_interval)
+
+    def __init__(self, burst, interval, max_interval=None):
+        self.burst = burst
+        self.interval = self.min_interval = interval
+        self.max_interval = max(max_interval or interval, interval)
+        self.tokens = burst
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+bucket = TokenBucket(flood_burst, flood_interval, max_interval)
+
+# Messages generated by stdinbot (rather than read from the input)
+class _Summary(str):
+    __slots__ = ()
+
+# Suppress repeated lines. self.last is the hash of the last line that
+#   wasn't suppressed, and only the hashes of the last `size` lines are
+#   stored.
+class Deduplicator:
+    __slots__ = ('repeats', 'size', 'interval', 'window', 'counts',
+        'suppressed', 'last', 'mixed', 'since')
+
+    # Returns True if line is a repeat and should be suppressed.
+    def seen(self, line):
+        if not self.repeats and not self.size:
+            return False
+        h = hash(line)
+        if self.size:
+            if len(self.window) >= self.size:
+                old = self.window.popleft()
+                if self.counts[old] > 1:
+                    self.counts[old] -= 1
+                else:
+                    del self.counts[old]
+            self.window.append(h)
+            self.counts[h] = self.counts.get(h, 0) + 1
+
+        if self.repeats and h == self.last:
+            pass
+        elif self.size and self.counts[h] > 1:
+            self.mixed = True
+        else:
+            self.last = h
+            return False
+
+        if not self.suppressed:
+            self.since = time.monotonic()
+        self.suppressed += 1
+        return True
+
+    # Get the "repeated" message (if any) and reset the suppressed count.
+    def summary(self):
+        if not self.suppressed:
+            return None
+        plural = '' if self.suppressed == 1 else 's'
+        if self.mixed:
+            msg = '{} repeated line' + plural + ' suppressed'
+        else:
+            msg = 'Last line repeated {} time' + plural
+        msg = _Summary(msg.format(self.suppressed))
+        self.suppressed = 0
+        self.mixed = False
+        return msg
+
+    # Returns True if lines have been suppressed for longer than interval.
+    def expired(self):
+        return (self.suppressed and
+            time.monotonic() - self.since >= self.interval)
+
+    def __init__(self, size, interval, repeats=True):
+        self.repeats = repeats
+        self.size = size
+        self.interval = interval
+        self.window = deque()
+        self.counts = {}
+        self.suppressed = 0
+        self.mixed = False
+        self.last = self.since = None
+
+dedup = Deduplicator(dedup_window, dedup_interval, dedup_repeats)
+
+# Throughput statistics
+stats = {'lines': 0, 'messages': 0, 'bytes': 0, 'queued': 0, 'dropped': 0,
+    'suppressed': 0, 'skipped': 0}
+_start_time = time.monotonic()
+
+def print_stats():
+    elapsed = max(time.monotonic() - _start_time, 0.001)
+    print(('stdinbot: {lines} lines sent in {messages} messages ({bytes} '
+        'bytes), {0:.2f} lines/s, {1:.2f} messages/s, {queued} lines '
+        'queued, {dropped} dropped, {suppressed} suppressed as repeats, '
+        '{skipped} skipped in bursts.').format(
+        stats['lines'] / elapsed, stats['messages'] / elapsed, **stats),
+        file=sys.stderr)
+
+# Get the maximum amount of bytes that can be sent in one PRIVMSG to target.
+#   The server adds ":nick!ident@host " when relaying the message, and
+#   hostnames can be up to 63 bytes long.
+def get_byte_limit(irc, target):
+    overhead = len('PRIVMSG {} :\r\n'.format(target).encode('utf-8'))
+    overhead += len(':{}!{}@ '.format(irc.nick, irc.ident).encode('utf-8'))
+    return irc.msglen - overhead - 63
+
+# Pack as many pending lines as possible into one message. Lines that are too
+#   long to fit are split and the remainder is put back into pending.
+def pack_lines(pending, limit):
+    msg = b'\xe2\x80\x8b'
+    sep = separator.encode('utf-8')
+    count = 0
+    while pending:
+        if isinstance(pending[0], _Checkpoint):
+            pending.popleft().commit()
+            continue
+
+        line = pending[0].encode('utf-8')
+        if count:
+            if len(msg) + len(sep) + len(line) > limit:
+                break
+            msg += sep
+        elif len(msg) + len(line) > limit:
+            # Split the line without splitting UTF-8 characters.
+            line = line[:limit - len(msg)].decode('utf-8', 'ignore')
+            pending[0] = pending[0][len(line):]
+            return msg.decode('utf-8') + line, 0
+
+        msg += line
+        pending.popleft()
+        count += 1
+    return msg.decode('utf-8'), count
+
+# Lines are read from stdin into _queue by _reader() and are sent by
+#   _sender().
+if queue_policy not in ('block', 'drop-oldest', 'drop-newest'):
+    raise ValueError('Invalid queue_policy: {!r}'.format(queue_policy))
+_queue = queue.Queue(queue_size)
+_EOF = object()
+
+# Add a line to _queue, applying queue_policy if it is full.
+def enqueue(line):
+    if queue_policy == 'block':
+        _queue.put(line)
+    else:
+        while True:
+            try:
+                _queue.put_nowait(line)
+                break
+            except queue.Full:
+                stats['dropped'] += 1
+                if queue_policy == 'drop-newest':
+                    return
+            try:
+                _queue.get_nowait()
+            except queue.Empty:
+                pass
+    stats['queued'] += 1
+
+def _reader():
     while True:
         try:
-            line = '\u200b' + input().replace('\r', '').replace('\n', '  ')
+            line = input().replace('\r', '').replace('\n', '  ')
         except:
-            line = '\x04'
+            break
         if line == '\x04':
-            return irc.disconnect(qmsg)
-        irc.msg(channels[0], line)
-        time.sleep(interval)
+            break
+        enqueue(line)
+    _queue.put(_EOF)
 
-if __name__ == '__main__':
+# Follow mode
+_offsets = {}
+_offsets_changed = False
+
+def load_offsets():
+    if not offset_file:
+        return
+    try:
+        with open(offset_file, 'r') as f:
+            _offsets.update(json.load(f))
+    except FileNotFoundError:
+        pass
+
+def save_offsets():
+    global _offsets_changed
+    if not offset_file or not _offsets_changed:
+        return
+    _offsets_changed = False
+    tmp = offset_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(_offsets, f)
+    os.replace(tmp, offset_file)
+
+# Checkpoints are added to _queue after the lines they refer to and are
+#   committed once those lines have been packed into a message.
+class _Checkpoint:
+    __slots__ = ('path', 'dev', 'ino', 'offset')
+
+    def commit(self):
+        global _offsets_changed
+        _offsets[self.path] = [self.dev, self.ino, self.offset]
+        _offsets_changed = True
+
+    def __init__(self, path, dev, ino, offset):
+        self.path = path
+        self.dev = dev
+        self.ino = ino
+        self.offset = offset
+
+class _FollowedFile:
+    __slots__ = ('path', 'file', 'dev', 'ino', 'offset', 'partial')
+
+    def _open(self, st, offset):
+        self.file = open(self.path, 'rb', buffering=0)
+        self.dev, self.ino = st.st_dev, st.st_ino
+        self.offset = offset
+        self.partial = b''
+        if offset:
+            self.file.seek(offset)
+
+    # Read everything that has been appended to the file.
+    def read(self):
+        if not self.file:
+            return False
+        found = False
+        while True:
+            data = self.file.read(read_size)
+            if not data:
+                return found
+            found = True
+            self.offset += len(data)
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()
+            for line in lines:
+                enqueue(line.decode('utf-8', 'replace').replace('\r', ''))
+            # This blocks like the "block" policy does so that checkpoints
+            #   aren't lost when the queue is full.
+            if lines:
+                _queue.put(_Checkpoint(self.path, self.dev, self.ino,
+                    self.offset - len(self.partial)))
+
+    # Check for rotation and truncation.
+    def check(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if not self.file:
+            self._open(st, 0)
+        elif (st.st_dev, st.st_ino) != (self.dev, self.ino):
+            # The file has been rotated, finish reading the old one first.
+            self.read()
+            self.file.close()
+            self._open(st, 0)
+        elif st.st_size < self.offset:
+            print('stdinbot: {} has been truncated.'.format(self.path),
+                file=sys.stderr)
+            self.file.seek(0)
+            self.offset = 0
+            self.partial = b''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+
+        # Continue from the saved offset if the file hasn't been rotated or
+        #   truncated, and start at the beginning if it has (so lines
+        #   written while stopped aren't skipped). Files without a saved
+        #   offset are read from the end.
+        saved = _offsets.get(path)
+        if not saved:
+            self._open(st, st.st_size)
+        elif (saved[:2] == [st.st_dev, st.st_ino] and
+                saved[2] <= st.st_size):
+            self._open(st, saved[2])
+        else:
+            self._open(st, 0)
+
+def _follower(paths):
+    load_offsets()
+    files = [_FollowedFile(path) for path in paths]
+    next_check = time.monotonic() + poll_interval
+    while True:
+        found = False
+        for file in files:
+            if file.read():
+                found = True
+        if not found:
+            time.sleep(poll_interval)
+
+        # Check for rotation every poll_interval seconds, even if another
+        #   file is busy.
+        if time.monotonic() >= next_check:
+            next_check = time.monotonic() + poll_interval
+            for file in files:
+                file.check()
+
+def _add_summary(pending):
+    summary = dedup.summary()
+    if summary:
+        pending.append(summary)
+
+# Move lines from _queue to pending. pending is limited to queue_size lines so
+#   that the "block" policy still works.
+def _get_pending(pending, block=False):
+    try:
+        while len(pending) < queue_size:
+            # Wake up to send the "repeated" message if nothing else happens.
+            timeout = block and dedup.suppressed and dedup.interval or None
+            line = _queue.get(block, timeout)
+            block = False
+            if line is _EOF:
+                _add_summary(pending)
+                return False
+            elif isinstance(line, _Checkpoint):
+                if not pending:
+                    # Everything before this checkpoint has already been sent.
+                    line.commit()
+                    continue
+            elif dedup.seen(line):
+                stats['suppressed'] += 1
+                if dedup.expired():
+                    _add_summary(pending)
+                continue
+            else:
+                _add_summary(pending)
+            pending.append(line)
+    except queue.Empty:
+        if block:
+            _add_summary(pending)
+    return True
+
+# Replace everything except the last burst_keep lines in pending with a
+#   summary.
+def _summarise_backlog(pending):
+    skipped = 0
+    checkpoint = None
+    while len(pending) > burst_keep:
+        line = pending.popleft()
+        if isinstance(line, _Checkpoint):
+            checkpoint = line
+        elif not isinstance(line, _Summary):
+            skipped += 1
+    if checkpoint:
+        pending.appendleft(checkpoint)
+    pending.appendleft(_Summary('[{} lines skipped]'.format(skipped)))
+    stats['skipped'] += skipped
+
+def _sender(irc):
+    qmsg = 'I reached the end of my file, therefore my life™.'
+    pending = deque()
+    running = True
+    last_stats = time.monotonic()
+    while running or pending:
+        if running and not pending:
+            running = _get_pending(pending, block=True)
+            if not pending:
+                continue
+
+        # Keep any pending lines while reconnecting. Lines that arrive while
+        #   waiting are packed into the same message.
+        while not irc.connected:
+            time.sleep(0.5)
+        bucket.take()
+        if running:
+            running = _get_pending(pending)
+        if burst_threshold and len(pending) > burst_threshold:
+            _summarise_backlog(pending)
+
+        msg, count = pack_lines(pending, get_byte_limit(irc, channels[0]))
+        irc.msg(channels[0], msg)
+        bucket.speed_up()
+
+        stats['lines'] += count
+        stats['messages'] += 1
+        stats['bytes'] += len(msg.encode('utf-8'))
+        if stats_interval and time.monotonic() - last_stats >= stats_interval:
+            last_stats = time.monotonic()
+            print_stats()
+        save_offsets()
+
+    print_stats()
+    save_offsets()
+    irc.disconnect(qmsg)
+
+# Socket mode: Every target has a queue for each producer (client), and
+#   lines are taken from producers and targets in a round-robin order.
+class _Target:
+    __slots__ = ('producers', 'staging')
+
+    def __init__(self):
+        self.producers = OrderedDict()
+        self.staging = deque()
+
+class Multiplexer:
+    __slots__ = ('targets', 'cond')
+
+    # Add [(target, line), ...] to the queues, applying queue_policy.
+    def put(self, producer, items):
+        with self.cond:
+            for target, line in items:
+                while True:
+                    t = self.targets.get(target)
+                    if t is None:
+                        t = self.targets[target] = _Target()
+                    q = t.producers.get(producer)
+                    if q is None:
+                        q = t.producers[producer] = deque()
+                    if len(q) < queue_size:
+                        q.append(line)
+                        stats['queued'] += 1
+                        break
+                    elif queue_policy == 'block':
+                        self.cond.notify_all()
+                        self.cond.wait()
+                        continue
+
+                    stats['dropped'] += 1
+                    if queue_policy == 'drop-newest':
+                        break
+                    q.popleft()
+            self.cond.notify_all()
+
+    # Wait until there is something to send.
+    def wait(self):
+        with self.cond:
+            while not self.targets:
+                self.cond.wait()
+
+    # Get the next message to send. limit is a function that returns the byte
+    #   limit for a target.
+    def get(self, limit):
+        with self.cond:
+            while not self.targets:
+                self.cond.wait()
+            name, t = next(iter(self.targets.items()))
+            self.targets.move_to_end(name)
+            limit = limit(name)
+
+            # Move lines into the staging area one producer at a time.
+            size = sum(len(line.encode('utf-8')) for line in t.staging)
+            while t.producers and size < limit:
+                producer, q = next(iter(t.producers.items()))
+                line = q.popleft()
+                t.staging.append(line)
+                size += len(line.encode('utf-8')) + len(separator)
+                if q:
+                    t.producers.move_to_end(producer)
+                else:
+                    del t.producers[producer]
+
+            msg, count = pack_lines(t.staging, limit)
+            if not t.staging and not t.producers:
+                del self.targets[name]
+            self.cond.notify_all()
+            return name, msg, count
+
+    def __init__(self):
+        self.targets = OrderedDict()
+        self.cond = threading.Condition()
+
+mux = Multiplexer()
+
+# Convert a JSON object (or list of objects) into [(target, line), ...].
+def _parse_items(data):
+    if isinstance(data, dict):
+        data = (data,)
+    elif not isinstance(data, list):
+        raise TypeError('Expected an object or a list of objects.')
+
+    res = []
+    for item in data:
+        if not isinstance(item, dict):
+            raise TypeError('Expected an object or a list of objects.')
+        target = item.get('target', channels[0])
+        if (not isinstance(target, str) or not target or
+                any(c in target for c in ' ,\r\n\0')):
+            raise ValueError('Invalid target: {!r}'.format(target))
+        text = item.get('text')
+        if isinstance(text, str):
+            text = (text,)
+        elif not isinstance(text, list) or not all(isinstance(line, str)
+                for line in text):
+            raise TypeError('"text" must be a string or a list of strings.')
+        for lines in text:
+            for line in lines.replace('\r', '').split('\n'):
+                res.append((target, line))
+    return res
+
+class _ProducerHandler(socketserver.StreamRequestHandler):
+    def _error(self, msg):
+        try:
+            self.wfile.write(json.dumps({'error': msg}).encode('utf-8') +
+                b'\n')
+        except OSError:
+            pass
+
+    def handle(self):
+        for raw in self.rfile:
+            if not raw.strip():
+                continue
+            try:
+                items = _parse_items(json.loads(raw.decode('utf-8',
+                    'replace')))
+            except ValueError as e:
+                self._error(str(e) or 'Invalid JSON')
+                continue
+            except TypeError as e:
+                self._error(str(e))
+                continue
+            mux.put(self, items)
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def _serve(path):
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    server = _Server(path, _ProducerHandler)
+    os.chmod(path, socket_mode)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# JOIN channels before sending messages to them.
+def _join(irc, target):
+    if (target[:1] in irc.isupport.get('CHANTYPES', '#&') and
+            target not in irc.channels):
+        irc.channels.add(target)
+        irc.quote('JOIN', target)
+
+def _mux_sender(irc):
+    last_stats = time.monotonic()
+    while True:
+        mux.wait()
+        while not irc.connected:
+            time.sleep(0.5)
+        bucket.take()
+        target, msg, count = mux.get(lambda target : get_byte_limit(irc,
+            target))
+        _join(irc, target)
+        irc.msg(target, msg)
+        bucket.speed_up()
+
+        stats['lines'] += count
+        stats['messages'] += 1
+        stats['bytes'] += len(msg.encode('utf-8'))
+        if stats_interval and time.monotonic() - last_stats >= stats_interval:
+            last_stats = time.monotonic()
+            print_stats()
+
+# Submit a batch of messages ([{'target': ..., 'text': ...}, ...]) to a
+#   stdinbot running in socket mode.
+def submit(path, messages):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(messages).encode('utf-8') + b'\n')
+    finally:
+        sock.close()
+
+# Back off when the server complains about flooding.
+@irc.Handler('263', '439', colon=False)
+def handle_flood_numeric(irc, hostmask, args):
+    bucket.slow_down()
+
+@irc.Handler('NOTICE', colon=False)
+def handle_flood_notice(irc, hostmask, args):
+    if hostmask[0] == hostmask[2] and 'flood' in args[-1].lower():
+        bucket.slow_down()
+
+# Start reading stdin before connecting, _sender() will wait until the bot
+#   is connected (and for reconnects) before sending anything.
+def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', nargs='*', help='Files to follow instead of '
+        'reading stdin.')
+    parser.add_argument('--socket', help='Accept JSON messages on this UNIX '
+        'socket instead of reading stdin.')
+    args = parser.parse_args()
+
+    if args.socket:
+        _serve(args.socket)
+        threading.Thread(target=_mux_sender, args=(irc,), daemon=True).start()
+        return irc.connect()
+    elif args.file:
+        threading.Thread(target=_follower, args=(args.file,),
+            daemon=True).start()
+    else:
+        threading.Thread(target=_reader, daemon=True).start()
+    threading.Thread(target=_sender, args=(irc,), daemon=True).start()
     irc.connect()
+
+if __name__ == '__main__':
+    main()